@@ -38,6 +38,7 @@ class Dispatcher:
         self.prog = prog
 
         import scarphase_dump
+        import scarphase_fsck
         import scarphase_plot
         import scarphase_profile
         import scarphase_show
@@ -75,6 +76,11 @@ class Dispatcher:
                 help="Find simpoints"
                 ),
 
+            "fsck"    : Dispatcher.CmdData(
+                func=scarphase_fsck.run, 
+                help="Check data files"
+                ),
+
             }
 
 
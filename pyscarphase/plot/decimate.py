@@ -0,0 +1,139 @@
+# Copyright (c) 2011-2013 Andreas Sembrant
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#  - Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  - Neither the name of the copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Authors: Andreas Sembrant
+
+'''
+Level-of-detail line plots of long traces.
+
+A trace is reduced to at most two points (min and max) per pixel column
+of the axes, from a pyramid of min/max values over blocks of 2^k windows.
+The line is recomputed from the pyramid when the axes are zoomed.
+'''
+
+import numpy as np
+
+class Pyramid:
+    '''
+    Min/max of values over blocks of 1, 2, 4, ... windows.
+
+    Level k has the min and max of windows [i * 2^k, (i + 1) * 2^k).
+    nan values are ignored.
+    '''
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=np.float64)
+
+        self.mins = [ values ]
+        self.maxs = [ values ]
+
+        while len(self.mins[-1]) > 1:
+            mins, maxs = self.mins[-1], self.maxs[-1]
+
+            # Pad to an even length
+            if len(mins) % 2:
+                mins = np.append(mins, np.nan)
+                maxs = np.append(maxs, np.nan)
+
+            with np.errstate(invalid='ignore'):
+                self.mins.append(np.fmin(mins[0::2], mins[1::2]))
+                self.maxs.append(np.fmax(maxs[0::2], maxs[1::2]))
+
+    def __len__(self):
+        return len(self.mins[0])
+
+    def decimate(self, xmin, xmax, points):
+        '''
+        Get (x, y) of the windows in [xmin, xmax), with about points min
+        and max pairs, or the windows themselves if there are fewer.
+        '''
+
+        xmin = max(0, int(np.floor(xmin)))
+        xmax = min(len(self), int(np.ceil(xmax)) + 1)
+
+        # Coarsest level with at least points blocks in range
+        level = 0
+        while level + 1 < len(self.mins) and \
+                (xmax - xmin) >> (level + 1) >= points:
+            level += 1
+
+        if level == 0:
+            x = np.arange(xmin, xmax)
+            return x, self.mins[0][xmin:xmax]
+
+        size = 1 << level
+
+        # Include one block outside on each side, so the line reaches
+        # the edges of the axes
+        start = max(0, xmin // size - 1)
+        stop  = min(len(self.mins[level]), xmax // size + 2)
+
+        blocks = np.arange(start, stop)
+
+        # Centre of windows [i * size, (i + 1) * size - 1]
+        x = np.repeat(blocks * size + (size - 1) / 2.0, 2)
+
+        y = np.empty(len(x))
+        y[0::2] = self.mins[level][start:stop]
+        y[1::2] = self.maxs[level][start:stop]
+
+        return x, y
+
+
+class Updater:
+    '''Recompute the decimated line when the axes are zoomed.'''
+
+    def __init__(self, line, pyramid):
+        self.line = line
+        self.pyramid = pyramid
+
+    def __call__(self, ax):
+        xmin, xmax = ax.get_xlim()
+
+        # One min/max pair per pixel column
+        points = max(1, int(ax.get_window_extent().width))
+
+        self.line.set_data(*self.pyramid.decimate(xmin, xmax, points))
+
+
+def plot(ax, values, **kwargs):
+    '''
+    Plot values against window index, like ax.plot(values, **kwargs),
+    but decimated to the resolution of the axes. Returns the line.
+    '''
+
+    pyramid = Pyramid(values)
+
+    # Start with the whole trace
+    points = max(1, int(ax.get_window_extent().width))
+
+    line, = ax.plot(*pyramid.decimate(0, len(pyramid), points), **kwargs)
+
+    ax.callbacks.connect('xlim_changed', Updater(line, pyramid))
+
+    return line
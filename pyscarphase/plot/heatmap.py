@@ -0,0 +1,134 @@
+# Copyright (c) 2011-2013 Andreas Sembrant
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#  - Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  - Neither the name of the copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Authors: Andreas Sembrant
+
+'''
+Rasterized signature heatmaps.
+
+Instead of drawing one image column per window, the windows are reduced
+to a fixed number of pixel columns (mean or max of the windows in each
+column), reading the signatures a chunk at a time. The signatures are
+typically memory mapped columns, see pyscarphase.util.columns.
+'''
+
+import numpy as np
+import matplotlib.cm
+
+REDUCE = {
+    'mean' : np.add,
+    'max'  : np.fmax,
+    }
+
+def rasterize(signatures, start, stop, width, reduce='mean', 
+              chunk_size=64 * 1024):
+    '''
+    Reduce the signatures of windows [start, stop) to an image of
+    (dimensions x width) pixels. If there are fewer windows than pixels,
+    the windows themselves are returned.
+    '''
+
+    no_windows = stop - start
+
+    if no_windows <= width:
+        return np.asarray(signatures[start:stop], dtype=np.float64).T
+
+    ufunc = REDUCE[reduce]
+
+    image = np.zeros((width, signatures.shape[1]))
+    if reduce == 'max':
+        image.fill(np.nan)
+
+    # Windows per pixel column
+    counts = np.zeros(width)
+
+    for a in xrange(start, stop, chunk_size):
+        b = min(a + chunk_size, stop)
+
+        chunk = np.asarray(signatures[a:b], dtype=np.float64)
+
+        # Pixel column of each window, in increasing order
+        pixels = (np.arange(a, b) - start) * width // no_windows
+
+        bounds = np.concatenate(
+            ([ 0 ], np.flatnonzero(np.diff(pixels)) + 1))
+
+        columns = pixels[bounds]
+
+        image[columns] = ufunc(image[columns], 
+                               ufunc.reduceat(chunk, bounds, axis=0))
+
+        counts += np.bincount(pixels, minlength=width)
+
+    if reduce == 'mean':
+        image /= counts[:, np.newaxis]
+
+    return image.T
+
+
+class Heatmap:
+    '''Signature heatmap, re-rasterized when the axes are zoomed.'''
+
+    def __init__(self, ax, signatures, reduce='mean', retile=False):
+        self.ax = ax
+        self.signatures = signatures
+        self.reduce = reduce
+
+        self.image = ax.imshow(
+            self.__rasterize(0, len(signatures)),
+            aspect='auto', 
+            interpolation='nearest', 
+            cmap=matplotlib.cm.binary,
+            extent=self.__extent(0, len(signatures))
+            )
+
+        if retile:
+            ax.callbacks.connect('xlim_changed', self)
+
+    def __extent(self, start, stop):
+        return (start - 0.5, stop - 0.5, self.signatures.shape[1] - 0.5, -0.5)
+
+    def __rasterize(self, start, stop):
+        width = max(1, int(self.ax.get_window_extent().width))
+
+        return rasterize(self.signatures, start, stop, width, self.reduce)
+
+    def __call__(self, ax):
+        xmin, xmax = ax.get_xlim()
+
+        start = max(0, int(np.floor(xmin + 0.5)))
+        stop  = min(len(self.signatures), int(np.ceil(xmax + 0.5)))
+
+        if start >= stop:
+            return
+
+        self.image.set_data(self.__rasterize(start, stop))
+        self.image.set_extent(self.__extent(start, stop))
+
+        # set_extent autoscales, keep the zoom
+        ax.set_xlim(xmin, xmax, emit=False)
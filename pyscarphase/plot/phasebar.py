@@ -28,7 +28,10 @@
 #
 # Authors: Andreas Sembrant
 
+import numpy as np
+
 from matplotlib.ticker import NullFormatter
+from matplotlib.collections import PolyCollection
 
 import pyscarphase.util.runlength
 import pyscarphase.plot.color
@@ -42,20 +45,22 @@ def plot(ax, plot_ax, phase_list):
     ax.xaxis.set_major_formatter(NullFormatter())
     ax.yaxis.set_major_formatter(NullFormatter())
 
+    # Convert to only phase changes
+    pids, lengths, starts = pyscarphase.util.runlength.encode(phase_list)
+
     # Rank phases 
-    def rank_phases(phase_list):
-        phase_map = {}
-        for pid in phase_list:
-            phase_map[pid] = phase_map.get(pid, 0) + 1
+    def rank_phases(pids, lengths):
+        phases, inverse = np.unique(pids, return_inverse=True)
+        counts = np.bincount(inverse, weights=lengths)
 
-        return sorted(phase_map.iteritems(), 
+        return sorted(zip(phases.tolist(), counts.tolist()), 
                       key=lambda x: x[1], 
                       reverse=True)
 
 
 
     # Sort phases depending on rank
-    sorted_phase_map = rank_phases(phase_list)
+    sorted_phase_map = rank_phases(pids, lengths)
 
     # Create colors
     def create_color_map():
@@ -80,38 +85,92 @@ def plot(ax, plot_ax, phase_list):
 
     phase_color_map = create_color_map()
 
-    # Convert to only phase changes
-    compressed_phase_list = pyscarphase.util.runlength.encode(phase_list)
-
-    # Draw phase bar
-    i = 0
-    for pid, length in compressed_phase_list:
-        if pid in phase_color_map:
-            ax.axvspan(i, 
-                       i + length, 
-                       facecolor=phase_color_map[pid][0], 
-                       edgecolor=phase_color_map[pid][1],
-                       hatch=phase_color_map[pid][2], 
-                       lw=0.5) 
-            
-            ax.text(i + length / 2, 
-                    0.5, 
-                    '%i' % pid,
-                    size='xx-small',
-                    horizontalalignment='center',
-                    verticalalignment='center')
-
-        i += length
+    # Draw phase bar, one collection per color and hatch
+    for pid, (facecolor, edgecolor, hatch) in phase_color_map.iteritems():
+        mask = pids == pid
+
+        # Rectangle of each segment, (segments, corners, xy)
+        verts = np.empty((np.count_nonzero(mask), 4, 2))
+        verts[:, 0:2, 0] = starts[mask, np.newaxis]
+        verts[:, 2:4, 0] = (starts + lengths)[mask, np.newaxis]
+        verts[:, :, 1] = [ 0, 1, 1, 0 ]
 
+        ax.add_collection(
+            PolyCollection(verts, 
+                           facecolors=facecolor, 
+                           edgecolors=edgecolor,
+                           hatch=hatch, 
+                           lw=0.5)
+            )
+
+    ax.autoscale_view()
+    ax.set_ylim(0, 1)
+
+    # Only label phases with colors
+    labeled = np.in1d(pids, phase_color_map.keys())
+
+    labels = Labels(ax, pids[labeled], lengths[labeled], starts[labeled])
+    labels.update()
 
     # Connect bar so it follows zoom in/out in parent
     class Connector:
         
-        def __init__(self, ax):
+        def __init__(self, ax, labels):
             self.ax = ax
+            self.labels = labels
 
         def __call__(self, ax):
             self.ax.set_xlim(ax.get_xlim())
+            self.labels.update()
     
-    plot_ax.callbacks.connect('xlim_changed', func=Connector(ax))
+    return plot_ax.callbacks.connect(
+        'xlim_changed', func=Connector(ax, labels))
+
+
+class Labels:
+    '''
+    Phase id labels, only for the segments that are wide enough to fit
+    one at the current zoom.
+    '''
+
+    # Minimum segment width in pixels
+    MIN_WIDTH = 12
+
+    def __init__(self, ax, pids, lengths, starts):
+        self.ax = ax
+        self.pids = pids
+        self.lengths = lengths
+        self.starts = starts
+
+        self.texts = []
+
+    def update(self):
+
+        for text in self.texts:
+            text.remove()
+
+        self.texts = []
+
+        xmin, xmax = self.ax.get_xlim()
+
+        if xmax <= xmin:
+            return
+
+        # Pixels per window
+        scale = self.ax.get_window_extent().width / (xmax - xmin)
+
+        visible = (self.starts + self.lengths > xmin) & \
+            (self.starts < xmax) & \
+            (self.lengths * scale >= Labels.MIN_WIDTH)
 
+        for pid, length, i in zip(self.pids[visible].tolist(),
+                                  self.lengths[visible].tolist(),
+                                  self.starts[visible].tolist()):
+            self.texts.append(
+                self.ax.text(i + length / 2.0, 
+                             0.5, 
+                             '%i' % pid,
+                             size='xx-small',
+                             horizontalalignment='center',
+                             verticalalignment='center')
+                )
@@ -28,8 +28,373 @@
 #
 # Authors: Andreas Sembrant
 
-import os, sys, struct
+import os, sys, time, struct, mmap, bisect, zlib, collections
+import numpy as np
 from pyscarphase.proto import data_pb2 as data_pb
+from pyscarphase.proto import index as data_index
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# File format versions, see Header in data.proto
+(FORMAT_RECORDS, FORMAT_BLOCKS, FORMAT_CHECKED) = range(1, 4)
+
+# Record prefix, <size> or <size><crc32>
+PREFIX = {
+    FORMAT_RECORDS : struct.Struct('<i'),
+    FORMAT_BLOCKS  : struct.Struct('<i'),
+    FORMAT_CHECKED : struct.Struct('<iI'),
+    }
+
+# name -> (Header.Compression, compress, decompress)
+COMPRESSION = {
+    'zlib' : (data_pb.Header.ZLIB, zlib.compress, zlib.decompress),
+    }
+
+if lzma:
+    COMPRESSION['lzma'] = (data_pb.Header.LZMA, lzma.compress, lzma.decompress)
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def _parse_accepts_memoryview():
+    '''Check if protobuf can parse directly from a memoryview.'''
+
+    try:
+        data_pb.Header().ParseFromString(memoryview(b''))
+    except TypeError:
+        return False
+
+    return True
+
+PARSE_MEMORYVIEW = _parse_accepts_memoryview()
+
+
+if sys.version_info[0] < 3:
+    _byte = ord
+else:
+    _byte = int
+
+class FieldProjection:
+    '''
+    Extract top-level fields from a serialized message, without parsing it.
+
+    Only the tags are decoded, the other fields are skipped over. Since
+    protobuf serializes fields in field number order, the scan stops at
+    the first field after the last selected one, e.g., selecting
+    phase_info never touches the code samples or stack traces of a window.
+
+    The scan is a Python loop, stepping over a repeated field is slower
+    than letting protobuf parse it, see cheap().
+    '''
+
+    def __init__(self, descriptor, fields):
+        self.numbers = set()
+
+        for name in fields:
+            if name not in descriptor.fields_by_name:
+                raise ValueError('Unknown field: %s' % (name))
+
+            self.numbers.add(descriptor.fields_by_name[name].number)
+
+        self.last = max(self.numbers)
+
+        # First repeated field, e.g., the code samples of a window
+        self.first_repeated = min(
+            [ f.number for f in descriptor.fields 
+              if f.label == f.LABEL_REPEATED ] or [ self.last + 1 ])
+
+    def cheap(self):
+        '''True if the scan stops before the first repeated field.'''
+        return self.last < self.first_repeated
+
+    def __call__(self, data):
+
+        def _varint(pos):
+            value, shift = 0, 0
+            while True:
+                b = _byte(data[pos])
+                value |= (b & 0x7f) << shift
+                pos += 1
+
+                if not b & 0x80:
+                    return value, pos
+
+                shift += 7
+
+        # Selected (start, stop) ranges, adjacent fields are merged
+        ranges = []
+
+        pos, end = 0, len(data)
+        while pos < end:
+            start = pos
+
+            tag, pos = _varint(pos)
+            number, wire_type = tag >> 3, tag & 0x7
+
+            if number > self.last:
+                break
+
+            if wire_type == 0:
+                _, pos = _varint(pos)
+            elif wire_type == 1:
+                pos += 8
+            elif wire_type == 2:
+                length, pos = _varint(pos)
+                pos += length
+            elif wire_type == 5:
+                pos += 4
+            else:
+                raise ValueError('Unsupported wire type: %i' % (wire_type))
+
+            if number in self.numbers:
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], pos)
+                else:
+                    ranges.append((start, pos))
+
+        if len(ranges) == 1:
+            return data[ranges[0][0]:ranges[0][1]]
+
+        return b''.join(data[start:stop] for start, stop in ranges)
+
+
+class MappedFile:
+    '''
+    Read-only file object on top of a memory mapping.
+
+    read_buffer() returns a memoryview into the mapping instead of a copy,
+    if protobuf accepts memoryviews.
+    '''
+
+    def __init__(self, f):
+        self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offset = f.tell()
+
+        self.view = None
+
+        if PARSE_MEMORYVIEW:
+            try:
+                self.view = memoryview(self.buffer)
+            except TypeError:
+                pass
+
+    def read(self, size):
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+
+        return data
+
+    def read_buffer(self, size):
+        if self.view is None:
+            return self.read(size)
+
+        data = self.view[self.offset:self.offset + size]
+        self.offset += len(data)
+
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence == os.SEEK_END:
+            offset += len(self.buffer)
+
+        # Same as a file, but never past the end of the mapping
+        self.offset = max(0, min(offset, len(self.buffer)))
+
+    def tell(self):
+        return self.offset
+
+
+class BlockFile:
+    '''
+    Read-only file object with the decompressed content of a block file.
+
+    <size of block 0>
+    <decompressed size of block 0>
+    <block 0>
+    <size of block 1>
+    <decompressed size of block 1>
+    <block 1>
+    ...
+
+    Offsets from the first block and onwards refer to the decompressed
+    blocks, i.e., the blocks read as one continuous stream. Only the block
+    containing the current offset is decompressed.
+    '''
+
+    def __init__(self, f, decompress):
+        self.file = f
+        self.decompress = decompress
+
+        self.base = f.tell()
+        self.offset = self.base
+
+        # Block index, file offsets and decompressed start offsets
+        self.block_offsets = []
+        self.block_sizes   = []
+        self.block_starts  = [ self.base ]
+
+        # Currently decompressed block
+        self.block = None
+        self.data  = b''
+
+        self.__read_blocks()
+
+    def __read_blocks(self):
+        '''Build block index from the block sizes.'''
+
+        self.file.seek(0, os.SEEK_END)
+        file_size = self.file.tell()
+
+        position = self.base
+        while True:
+            self.file.seek(position)
+            data = self.file.read(8)
+
+            if len(data) != 8:
+                break
+
+            size, length = struct.unpack('<ii', data)
+
+            # Ignore truncated blocks
+            if position + 8 + size > file_size:
+                break
+
+            self.block_offsets.append(position + 8)
+            self.block_sizes.append(size)
+            self.block_starts.append(self.block_starts[-1] + length)
+
+            position += 8 + size
+
+    def __load(self, block):
+        if self.block != block:
+            self.file.seek(self.block_offsets[block])
+            self.data  = self.decompress(
+                self.file.read(self.block_sizes[block])
+                )
+            self.block = block
+
+    def read(self, size):
+        data = []
+
+        while size > 0 and self.offset < self.block_starts[-1]:
+            block = bisect.bisect_right(self.block_starts, self.offset) - 1
+            self.__load(block)
+
+            start = self.offset - self.block_starts[block]
+            data.append(self.data[start:start + size])
+
+            self.offset += len(data[-1])
+            size -= len(data[-1])
+
+        if len(data) == 1:
+            return data[0]
+
+        return b''.join(data)
+
+    def read_buffer(self, size):
+        return self.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence == os.SEEK_END:
+            offset += self.block_starts[-1]
+
+        self.offset = max(self.base, min(offset, self.block_starts[-1]))
+
+    def tell(self):
+        return self.offset
+
+
+class OffsetTable:
+    '''
+    Window offsets, stored in a growing uint64 array.
+
+    With stride N, only the offset of every Nth window is stored, and the
+    other windows are found by scanning forward from the nearest one. With
+    max_offsets, the stride is doubled (and every other offset dropped)
+    whenever the table would grow past max_offsets, i.e., the memory use
+    is bounded no matter how many windows there are.
+    '''
+
+    def __init__(self, stride=1, max_offsets=None):
+        self.stride      = stride
+        self.max_offsets = max_offsets
+
+        # No. windows, and offset of the last window
+        self.count = 0
+        self.last  = None
+
+        self.offsets = np.zeros(1024, dtype=np.uint64)
+        self.size    = 0
+
+    def __len__(self):
+        return self.count
+
+    def checkpoint(self, index):
+        '''Nearest window at or before index with a stored offset.'''
+
+        index -= index % self.stride
+
+        return index, int(self.offsets[index // self.stride])
+
+    def append(self, offset):
+
+        if self.count % self.stride == 0:
+            if self.max_offsets and self.size == self.max_offsets:
+                self.__compact()
+
+        if self.count % self.stride == 0:
+            if self.size == len(self.offsets):
+                # A loaded table may be empty
+                self.offsets = np.resize(
+                    self.offsets, max(2 * self.size, 1024))
+
+            self.offsets[self.size] = offset
+            self.size += 1
+
+        self.count += 1
+        self.last = offset
+
+    def load(self, offsets):
+        '''Replace the table with all window offsets, e.g., from an index.'''
+
+        self.count = len(offsets)
+        self.last  = int(offsets[-1]) if self.count else None
+
+        if self.max_offsets:
+            while (self.count + self.stride - 1) // self.stride \
+                    > self.max_offsets:
+                self.stride *= 2
+
+        # Only every stride-th offset is read, e.g., from a memory mapped
+        # index
+        self.offsets = np.array(offsets[::self.stride], dtype=np.uint64)
+        self.size    = len(self.offsets)
+
+    def array(self):
+        '''All window offsets, or None if only some are stored.'''
+
+        if self.stride != 1:
+            return None
+
+        return self.offsets[:self.size]
+
+    def __compact(self):
+        '''Double the stride, i.e., drop every other offset.'''
+
+        offsets = self.offsets[:self.size:2]
+
+        self.size = len(offsets)
+        self.offsets[:self.size] = offsets
+
+        self.stride *= 2
+
 
 class DataReader:
     '''
@@ -42,14 +407,55 @@ class DataReader:
     <size of window 1>
     <window 1>    
     ...
+
+    In version 2 files, the windows are grouped into compressed blocks
+    instead (see BlockFile). Only the block that contains the requested
+    window is decompressed. In version 3 files, each size is followed by
+    the crc32 of the window, which is checked when the window is read.
+
+    A window that was cut off at the end of the file, e.g., if
+    scarphase-profile was killed, is treated as end of file. Use
+    check() (scarphase fsck) to find and repair such files.
+
+    The window offsets are cached in a sidecar index (<filename>.idx),
+    which is built the first time the file is opened.
+
+    With use_mmap the file is memory mapped and windows are parsed straight
+    from the mapping, without any read calls.
+
+    With fields, e.g., [ 'phase_info', 'size' ], only those top-level
+    fields of each window are parsed, the rest are left unset. All fields
+    must come before the code samples, skipping the code samples in
+    Python is slower than parsing the whole window.
+
+    With stride or max_offsets, only some window offsets are kept in
+    memory (see OffsetTable), and a missing index is not saved.
+
+    With verify=False, the crc32s of version 3 files are not checked.
     '''
 
-    def __init__(self, filename, uuid=None):
-        self.messages  = []
+    def __init__(self, filename, uuid=None, index=True, use_mmap=False, 
+                 fields=None, stride=1, max_offsets=None, verify=True):
+        self.messages  = OffsetTable(stride, max_offsets)
         self.position  = 0
         self.eof       = None
+        self.verify    = verify
+
+        self.projection = None
+        if fields:
+            projection = \
+                FieldProjection(data_pb.WindowData.DESCRIPTOR, fields)
+
+            if not projection.cheap():
+                raise ValueError('Fields after the code samples can not be '
+                                 'projected: %s' % (', '.join(fields)))
 
-        self.open(filename, uuid)
+            self.projection = projection
+
+        self.open(filename, uuid, use_mmap)
+
+        if index:
+            self.__load_index()
 
     def __iter__(self):
         return self
@@ -57,7 +463,33 @@ class DataReader:
     def __next__(self):
         return self.next()
 
-    def open(self, filename, uuid=None):
+    def __len__(self):
+        self.__read_all()
+        return len(self.messages)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+
+            if step == 1:
+                return self.read_range(start, stop)
+
+            # Read all windows in one go, even if only some are used
+            if step < 0:
+                start, stop = stop + 1, start + 1
+
+            return self.read_range(start, stop)[::step]
+
+        if key < 0:
+            key += len(self)
+
+        if key < 0 or key >= len(self):
+            raise IndexError()
+
+        return self.get(key)
+
+    def open(self, filename, uuid=None, use_mmap=False):
+        self.filename = filename
         self.file = open(filename, 'rb')
 
         data = self.file.read(4)
@@ -69,12 +501,72 @@ class DataReader:
     
         data = self.file.read(size)
 
+        if len(data) != size:
+            raise EOFError()
+
         header = data_pb.Header()
         header.ParseFromString(data)
     
         if uuid and uuid != header.uuid:
             raise Exception('UUID mismatch')
 
+        if header.version > FORMAT_CHECKED:
+            raise Exception('Unsupported file version %i' % (header.version))
+
+        self.header = header
+        self.prefix = PREFIX[header.version]
+
+        if use_mmap:
+            self.file = MappedFile(self.file)
+
+        if header.version == FORMAT_BLOCKS:
+
+            decompress = None
+            for c, _, d in COMPRESSION.itervalues():
+                if c == header.compression:
+                    decompress = d
+
+            if decompress is None:
+                raise Exception('Unsupported compression')
+
+            self.file = BlockFile(self.file, decompress)
+
+        if use_mmap or header.version == FORMAT_BLOCKS:
+            self.__read_buffer = self.file.read_buffer
+        else:
+            self.__read_buffer = self.file.read
+
+        self.end = self.__file_end()
+
+    def __file_end(self):
+        '''End of the (decompressed) file.'''
+
+        current = self.file.tell()
+
+        self.file.seek(0, os.SEEK_END)
+        end = self.file.tell()
+
+        self.file.seek(current)
+
+        return end
+
+    def __load_index(self):
+        '''Load window offsets from sidecar index, or build it.'''
+
+        offsets = data_index.load_index(self.filename, self.header.uuid)
+
+        if offsets is not None:
+            self.messages.load(offsets)
+            self.eof = True
+            return
+
+        # Find all window offsets and save them for next time
+        self.__read_all()
+
+        if self.messages.array() is not None:
+            data_index.save_index(self.filename, self.header.uuid, 
+                                  self.messages.array())
+
     def read(self):
         pass
 
@@ -92,37 +584,120 @@ class DataReader:
         #
         return window
 
+    def read_range(self, start, stop):
+        '''
+        Read windows [start, stop) with one read of the file.
+
+        The current position is not changed.
+        '''
+
+        stop = min(stop, len(self))
+
+        if start >= stop:
+            return []
+
+        # Save position
+        cur_mpos, cur_fpos = self.position, self.file.tell()
+
+        prefix = self.prefix
+
+        # End of the last window
+        self.__goto(stop - 1)
+        size = prefix.unpack(self.file.read(prefix.size))[0]
+
+        end = self.file.tell() + size
+
+        # Read all windows
+        self.__goto(start)
+        data = self.__read_buffer(end - self.file.tell())
+
+        # Restore
+        self.position = cur_mpos
+        self.file.seek(cur_fpos)
+
+        # Split and parse windows
+        windows = []
+
+        offset = 0
+        for i in xrange(start, stop):
+            record = prefix.unpack(data[offset:offset + prefix.size])
+
+            offset += prefix.size
+            data_i = data[offset:offset + record[0]]
+            offset += record[0]
+
+            self.__verify(i, record, data_i)
+
+            windows.append(self.__parse(data_i))
+
+        return windows
+
     def __next(self, skip=True):
-        
+
+        start = self.file.tell()
+
         # Get message size
-        data = self.file.read(4)
+        data = self.file.read(self.prefix.size)
 
         # Check if end of file
-        if len(data) != 4:
-            self.eof = True
-            raise StopIteration()
+        if len(data) != self.prefix.size:
+            self.__truncated(start)
 
-        # Add to message position list
-        if self.position == len(self.messages):
-            self.messages.append(self.file.tell() - 4)
+        # Parse size
+        record = self.prefix.unpack(data)
+        size = record[0]
 
-        # 
-        self.position += 1
+        # Check that the whole message is in the file
+        if size < 0 or start + self.prefix.size + size > self.end:
+            self.end = self.__file_end()
+
+            if size < 0 or start + self.prefix.size + size > self.end:
+                self.__truncated(start)
 
-        # Parse size
-        size = struct.unpack('<i', data)[0]
-    
         if skip:
             self.file.seek(size, os.SEEK_CUR)
         else:
             # Read message
-            data = self.file.read(size)
+            data = self.__read_buffer(size)
+
+            self.__verify(self.position, record, data)
+
+        # Add to message position list
+        if self.position == len(self.messages):
+            self.messages.append(start)
+
+        # 
+        self.position += 1
+
+        if not skip:
+            return self.__parse(data)
 
-            # Parse message
-            window = data_pb.WindowData()
-            window.ParseFromString(data)
+    def __truncated(self, start):
+        '''End of file, or a window that was cut off.'''
 
-            return window
+        self.file.seek(start)
+        self.eof = True
+
+        raise StopIteration()
+
+    def __verify(self, index, record, data):
+        '''Check the crc32 of a window, version 3 only.'''
+
+        if self.verify and len(record) > 1 and record[1] != _crc32(data):
+            raise Exception('Checksum mismatch in window %i of %s, '
+                            'see scarphase fsck' % (index, self.filename))
+
+    def __parse(self, data):
+
+        # Drop fields that are not needed
+        if self.projection:
+            data = self.projection(data)
+
+        # Parse message
+        window = data_pb.WindowData()
+        window.ParseFromString(data)
+
+        return window
 
     def __read_all(self):
         if not self.eof:
@@ -130,8 +705,8 @@ class DataReader:
             try:
                 # Go to current end
                 if len(self.messages) != 0:
-                    current_end = len(self.messages) - 1
-                    self.file.seek(self.messages[current_end])
+                    self.position = len(self.messages) - 1
+                    self.file.seek(self.messages.last)
 
                 # Find end
                 while True:
@@ -145,6 +720,57 @@ class DataReader:
     def next(self):
         return self.__next(skip=False)
 
+    def poll(self):
+        '''
+        Read all windows appended since the last call, e.g., while
+        scarphase-profile is still writing the file.
+
+        A partially written window is left until it is complete.
+        '''
+
+        if isinstance(self.file, (MappedFile, BlockFile)):
+            raise Exception('Can only poll uncompressed, unmapped files')
+
+        windows = []
+
+        while True:
+            start = self.file.tell()
+
+            data = self.file.read(self.prefix.size)
+
+            if len(data) == self.prefix.size:
+                record = self.prefix.unpack(data)
+                data = self.file.read(record[0])
+
+                if len(data) == record[0]:
+                    self.__verify(self.position, record, data)
+
+                    if self.position == len(self.messages):
+                        self.messages.append(start)
+
+                    self.position += 1
+
+                    windows.append(self.__parse(data))
+                    continue
+
+            # Wait for the rest of the file
+            self.file.seek(start)
+            self.eof = None
+
+            return windows
+
+    def follow(self, interval=1.0):
+        '''Yield windows as they are appended to the file, never returns.'''
+
+        while True:
+            windows = self.poll()
+
+            if not windows:
+                time.sleep(interval)
+
+            for window in windows:
+                yield window
+
     def seek(self, position, whence=os.SEEK_SET):
         
         if self.position == position:
@@ -172,13 +798,12 @@ class DataReader:
             
         # If we know the offset already
         if position < len(self.messages):
-            self.position = position
-            self.file.seek(self.messages[self.position])
+            self.__goto(position)
         # iterate through messages until we reach right offset
         else:
             if len(self.messages) > 0:
                 self.position = len(self.messages) - 1
-                self.file.seek(self.messages[self.position])
+                self.file.seek(self.messages.last)
                 position = position - self.position
 
             try:
@@ -192,11 +817,162 @@ class DataReader:
     def tell(self):
         return self.position
 
+    def __goto(self, index):
+        '''Go to a window with a known offset, via its checkpoint.'''
+
+        self.position, offset = self.messages.checkpoint(index)
+        self.file.seek(offset)
+
+        while self.position < index:
+            self.__next(skip=True)
+
+
+def open_live(filename, interval=1.0, **kwargs):
+    '''
+    Open a data file that scarphase-profile is still writing, waits until
+    the header has been written. Use DataReader.poll() or follow() to read.
+    '''
+
+    while True:
+        try:
+            return DataReader(filename, index=False, **kwargs)
+        except (IOError, EOFError):
+            time.sleep(interval)
+
+
+Check = collections.namedtuple(
+    'Check', [ 'version', 'windows', 'end', 'size', 'error' ])
+
+def check(filename, checksums=True):
+    '''
+    Find the last complete window in a data file, by only scanning the
+    window sizes (and the crc32s in version 3 files, unless checksums is
+    False). Version 2 files are scanned block by block instead, each
+    block is decompressed to count its windows.
+
+    Returns Check(version, windows, end, size, error), where end is the
+    file offset right after the last good window (or block), and error
+    describes the first problem found, or is None.
+    '''
+
+    size = os.path.getsize(filename)
+
+    with open(filename, 'rb') as f:
+
+        # Header
+        data = f.read(4)
+
+        if len(data) != 4:
+            return Check(None, 0, 0, size, 'truncated header')
+
+        header_size = struct.unpack('<i', data)[0]
+
+        data = f.read(header_size)
+
+        if header_size < 0 or len(data) != header_size:
+            return Check(None, 0, 0, size, 'truncated header')
+
+        header = data_pb.Header()
+
+        try:
+            header.ParseFromString(data)
+        except Exception:
+            return Check(None, 0, 0, size, 'invalid header')
+
+        position = 4 + header_size
+
+        if header.version not in PREFIX:
+            return Check(header.version, 0, position, size, 
+                         'unsupported version')
+
+        if position == size:
+            return Check(header.version, 0, position, size, None)
+
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if header.version == FORMAT_BLOCKS:
+                result = _check_blocks(header, buf, position)
+            else:
+                result = _check_records(header, buf, position, checksums)
+        finally:
+            buf.close()
+
+    windows, position, error = result
+
+    return Check(header.version, windows, position, size, error)
+
+def _check_records(header, buf, position, checksums):
+
+    prefix, size = PREFIX[header.version], len(buf)
+
+    windows = 0
+    while position < size:
+        if position + prefix.size > size:
+            return windows, position, 'truncated window %i' % (windows)
+
+        record = prefix.unpack_from(buf, position)
+        end = position + prefix.size + record[0]
+
+        if record[0] < 0 or end > size:
+            return windows, position, 'truncated window %i' % (windows)
+
+        if checksums and len(record) > 1 and \
+                record[1] != _crc32(buf[position + prefix.size:end]):
+            return windows, position, 'checksum mismatch in window %i' % (
+                windows)
+
+        windows += 1
+        position = end
+
+    return windows, position, None
+
+def _check_blocks(header, buf, position):
+
+    decompress = None
+    for c, _, d in COMPRESSION.itervalues():
+        if c == header.compression:
+            decompress = d
+
+    if decompress is None:
+        return 0, position, 'unsupported compression'
+
+    prefix, size = PREFIX[FORMAT_RECORDS], len(buf)
+
+    windows = 0
+    while position < size:
+        if position + 8 > size:
+            return windows, position, 'truncated block'
+
+        block_size, length = struct.unpack_from('<ii', buf, position)
+        end = position + 8 + block_size
+
+        if block_size < 0 or end > size:
+            return windows, position, 'truncated block'
+
+        try:
+            data = decompress(buf[position + 8:end])
+        except Exception:
+            return windows, position, 'corrupt block'
+
+        if len(data) != length:
+            return windows, position, 'corrupt block'
+
+        # Count the windows in the block
+        offset = 0
+        while offset < length:
+            offset += prefix.size + prefix.unpack_from(data, offset)[0]
+            windows += 1
+
+        position = end
+
+    return windows, position, None
+
 
 class DataWriter:
    
     '''
-    Read scarphase protobuf data file
+    Write scarphase protobuf data file
 
     <size of header>
     <header>
@@ -205,26 +981,161 @@ class DataWriter:
     <size of window 1>
     <window 1>    
     ...
+
+    With compression ('zlib' or 'lzma'), a version 2 file is written
+    instead, where the windows are grouped into compressed blocks of
+    about block_size bytes (see BlockFile). With checksums, a version 3
+    file is written instead, where each size is followed by the crc32
+    of the window. The blocks already have their own checks, so the two
+    can not be combined.
+
+    Windows are buffered and written in batches to a temporary file
+    (<filename>_). When the writer is closed, the file is synced and
+    renamed to filename, and its sidecar index is saved.
+
+    with DataWriter(filename, uuid) as writer:
+        writer.write(window)
     '''
 
-    def __init__(self, filename, uuid=None):
-        self.open(filename, uuid)
+    def __init__(self, filename, uuid=None, buffer_size=4 * 1024 * 1024,
+                 compression=None, block_size=1024 * 1024, checksums=False):
+        self.buffer_size = buffer_size
+        self.block_size  = block_size
 
-    def open(self, filename, uuid=None):
+        self.open(filename, uuid, compression, checksums)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def open(self, filename, uuid=None, compression=None, checksums=False):
 
-        self.file = open(filename, 'wb')
-        self.uuid = uuid
-        
         header = data_pb.Header()
-        header.uuid = uuid
+
+        if uuid is not None:
+            header.uuid = uuid
+
+        self.compress = None
+
+        if compression:
+            if compression not in COMPRESSION:
+                raise ValueError('Unsupported compression: %s' % (compression))
+
+            if checksums:
+                raise ValueError('Checksums can not be used with compression')
+
+            header.version = FORMAT_BLOCKS
+            header.compression, self.compress, _ = COMPRESSION[compression]
+
+        if checksums:
+            header.version = FORMAT_CHECKED
+
+        self.checksums = checksums
+
+        self.filename = filename
+        self.tmpfile  = '%s_' % (filename)
+
+        self.file = open(self.tmpfile, 'wb')
+        self.uuid = uuid
+
+        self.buffer   = []
+        self.buffered = 0
+        self.offsets  = OffsetTable()
+
+        # Current block, if compressed
+        self.block          = []
+        self.block_buffered = 0
 
         data = header.SerializeToString()
-        self.file.write(struct.pack('<i', len(data)))
-        self.file.write(data)
-        self.file.flush()
+        self.__append(struct.pack('<i', len(data)), data)
+
+        # Window offsets continue in the decompressed blocks, see BlockFile
+        self.size = 4 + len(data)
 
     def write(self, window):
 
         data = window.SerializeToString()
-        self.file.write(struct.pack('<i', len(data)))
-        self.file.write(data)
+
+        self.offsets.append(self.size)
+
+        if self.checksums:
+            self.size += 8 + len(data)
+            self.__append(struct.pack('<iI', len(data), _crc32(data)), data)
+            return
+
+        self.size += 4 + len(data)
+
+        if self.compress is None:
+            self.__append(struct.pack('<i', len(data)), data)
+            return
+
+        self.block.append(struct.pack('<i', len(data)))
+        self.block.append(data)
+        self.block_buffered += 4 + len(data)
+
+        if self.block_buffered >= self.block_size:
+            self.__flush_block()
+
+    def __flush_block(self):
+
+        if not self.block:
+            return
+
+        data = b''.join(self.block)
+        compressed = self.compress(data)
+
+        self.__append(struct.pack('<ii', len(compressed), len(data)), 
+                      compressed)
+
+        self.block          = []
+        self.block_buffered = 0
+
+    def __append(self, *data):
+
+        for d in data:
+            self.buffer.append(d)
+            self.buffered += len(d)
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+
+        self.file.write(b''.join(self.buffer))
+
+        self.buffer   = []
+        self.buffered = 0
+
+    def close(self):
+        '''Finalize file, returns the number of windows.'''
+
+        self.__flush_block()
+        self.flush()
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+        # Remove the old index first, it might look valid for the new file
+        if os.path.exists(data_index.index_filename(self.filename)):
+            os.unlink(data_index.index_filename(self.filename))
+
+        os.rename(self.tmpfile, self.filename)
+
+        data_index.save_index(self.filename, self.uuid, self.offsets.array())
+
+        return len(self.offsets)
+
+    def abort(self):
+        '''Discard everything written so far.'''
+
+        self.file.close()
+        os.unlink(self.tmpfile)
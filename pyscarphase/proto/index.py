@@ -0,0 +1,131 @@
+# Copyright (c) 2011-2013 Andreas Sembrant
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#  - Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  - Neither the name of the copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Authors: Andreas Sembrant
+
+'''
+Sidecar offset index of a scarphase protobuf data file
+
+<magic>
+<version>
+<size of data file>
+<mtime of data file>
+<no. windows>
+<size of uuid>
+<uuid>
+<offset of window 0>
+<offset of window 1>
+...
+
+The index is only valid for a data file with the same header uuid, file
+size and mtime (see util.sidecar), otherwise it is rebuilt.
+'''
+
+import struct, binascii
+import numpy as np
+
+import pyscarphase.util.sidecar
+
+MAGIC   = 'SPIX'
+VERSION = 2
+
+HEADER  = '<4sIQdQI'
+OFFSET  = '<u8'
+
+def index_filename(filename):
+    return '%s.idx' % (filename)
+
+
+def load_index(filename, uuid):
+    '''
+    Load window offsets, memory mapped, returns None if there is no valid
+    index.
+    '''
+
+    try:
+        f = open(index_filename(filename), 'rb')
+    except IOError:
+        return None
+
+    with f:
+        data = f.read(struct.calcsize(HEADER))
+
+        if len(data) != struct.calcsize(HEADER):
+            return None
+
+        magic, version, file_size, mtime, no_windows, uuid_size = \
+            struct.unpack(HEADER, data)
+
+        if magic != MAGIC or version != VERSION:
+            return None
+
+        key = { 
+            'uuid'  : binascii.hexlify(f.read(uuid_size)), 
+            'size'  : file_size, 
+            'mtime' : mtime 
+            }
+
+        if key != pyscarphase.util.sidecar.file_key(filename, uuid):
+            return None
+
+        # Memory mapped, callers that only keep some offsets don't have
+        # to read all of them
+        start = f.tell()
+
+        f.seek(0, 2)
+        if f.tell() - start < no_windows * np.dtype(OFFSET).itemsize:
+            return None
+
+    if no_windows == 0:
+        return np.zeros(0, dtype=OFFSET)
+
+    return np.memmap(index_filename(filename), dtype=OFFSET, mode='r', 
+                     offset=start, shape=(no_windows,))
+
+
+def save_index(filename, uuid, offsets):
+    '''Save window offsets, returns False if the index can't be written.'''
+
+    uuid = uuid or ''
+
+    key = pyscarphase.util.sidecar.file_key(filename, uuid)
+
+    def _write(tmpfile):
+        with open(tmpfile, 'wb') as f:
+            f.write(struct.pack(HEADER, 
+                                MAGIC, 
+                                VERSION, 
+                                key['size'], 
+                                key['mtime'], 
+                                len(offsets), 
+                                len(uuid)))
+            f.write(uuid)
+
+            np.asarray(offsets, dtype=OFFSET).tofile(f)
+
+    return pyscarphase.util.sidecar.save(index_filename(filename), _write)
@@ -33,6 +33,8 @@ import sys, argparse
 import proto.meta
 import proto.data
 
+import util.demultiplexer
+
 import cmd
 
 class PrettyTableWrapper:
@@ -130,6 +132,21 @@ class DumpCmd(cmd.Cmd):
                 'windows',
                 help="Dump windows")
 
+            sub_parser.add_argument(
+                "--demux",
+                choices=sorted(util.demultiplexer.STRATEGIES.keys()), 
+                default="average",
+                help="How to fill in counters that were not sampled."
+                )
+
+            sub_parser.add_argument(
+                "--chunk-size",
+                dest="chunk_size",
+                type=int, default=None,
+                help="Stream the data file this many windows at a time, "
+                     "instead of loading the whole thread into memory."
+                )
+
             # 
             sub_parser.set_defaults(func=self.dump_windows)
             
@@ -183,6 +200,14 @@ class DumpCmd(cmd.Cmd):
 
         self.args = parser.parse_args(args[2:])
 
+        # The other strategies need the whole thread in memory
+        chunked = util.demultiplexer.ChunkedDemultiplexer.STRATEGIES
+
+        if getattr(self.args, 'chunk_size', None) \
+                and self.args.demux not in chunked:
+            parser.error('--chunk-size only supports --demux %s' % (
+                    ' or '.join(sorted(chunked.keys()))))
+
 
     def run(self):
         self.args.func()
@@ -196,7 +221,9 @@ class DumpCmd(cmd.Cmd):
         thread = profile.threads[self.args.thread]
 
         #
-        reader = proto.data.DataReader(
+        import util.columns
+
+        columns = util.columns.load_columns(
             thread.profile.filename,
             uuid=thread.profile.uuid
             )
@@ -209,9 +236,9 @@ class DumpCmd(cmd.Cmd):
         else:
             writer = PrettyTableWrapper(self.args.output_file, header)
 
-        for i, w in enumerate(reader):
-            for sample in w.perf_samples:
-                writer.write_row([i, w.phase_info.phase, sample.cid, sample.value])
+        for i, pid in enumerate(columns.phase):
+            for cid, value in columns.perf_samples(i):
+                writer.write_row([i, pid, cid, value])
 
 
     def dump_windows(self):
@@ -225,12 +252,6 @@ class DumpCmd(cmd.Cmd):
         # Get thread to dump
         thread = profile.threads[self.args.thread]
 
-        # Open a reader to that thread's datafile
-        reader = proto.data.DataReader(
-            thread.profile.filename,
-            uuid=thread.profile.uuid
-            )
-
         header = \
             [ "WID", "PID" ] + [ c.name for c in profile.performance_counters ]
 
@@ -239,22 +260,51 @@ class DumpCmd(cmd.Cmd):
         else:
             writer = PrettyTableWrapper(self.args.output_file, header)
 
+        if self.args.chunk_size:
+            chunks = self.__read_window_chunks(profile, thread)
+        else:
+            # All counters of all windows, cached next to the data file
+            chunks = [ util.demultiplexer.load_counters(
+                    thread.profile.filename,
+                    thread.profile.uuid,
+                    profile.performance_counters,
+                    self.args.demux
+                    ) ]
+
+        i = 0
+        for phase_list, values in chunks:
+            for pid, row in zip(phase_list.tolist(), values.tolist()):
+                # Print sampled (integral) counter values as integers
+                row = [ int(v) if v.is_integer() else v for v in row ]
+
+                writer.write_row([i, pid] + row)
+                i += 1
+
+    def __read_window_chunks(self, profile, thread):
+        '''Demultiplex and evaluate counters, a chunk at a time.'''
+
         import util.counter
-        import util.demultiplexer
 
-        dm = util.demultiplexer.Demultiplexer(reader)
+        # Keep a bounded number of window offsets in memory
+        reader = proto.data.DataReader(
+            thread.profile.filename,
+            uuid=thread.profile.uuid,
+            index=False,
+            use_mmap=True,
+            max_offsets=4096
+            )
 
-        for i, w in enumerate(dm.read()):
-            row = [i, w.phase]
+        dm = util.demultiplexer.ChunkedDemultiplexer(
+            reader, 
+            len(profile.performance_counters), 
+            self.args.demux,
+            self.args.chunk_size
+            )
 
-            for c in profile.performance_counters:
-                row.append(
-                    util.counter.exec_func(
-                        c.id, profile.performance_counters, w
-                        )
-                    )
+        plan = util.counter.CounterPlan(profile.performance_counters)
 
-            writer.write_row(row)
+        for phase_list, values, _ in dm.read():
+            yield phase_list, plan.evaluate(values)
 
 
     def dump_phase_instances(self):
@@ -280,7 +330,8 @@ class DumpCmd(cmd.Cmd):
         # Open a reader to that thread's datafile
         reader = proto.data.DataReader(
             thread.profile.filename,
-            uuid=thread.profile.uuid
+            uuid=thread.profile.uuid,
+            use_mmap=True
             )
         
         header = [ "Address", "Count" ]
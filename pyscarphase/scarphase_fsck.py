@@ -0,0 +1,203 @@
+# Copyright (c) 2011-2013 Andreas Sembrant
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#  - Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  - Neither the name of the copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Authors: Andreas Sembrant
+
+import os, argparse, itertools, fnmatch
+
+import pyscarphase.proto.data
+import pyscarphase.proto.index
+
+import cmd
+
+import prettytable 
+
+# Files written next to the data files, e.g., matched by gcc.profile.*
+SIDECARS = [ '*.idx', '*.columns', '*.columns_', '*.demux-*.npz' ]
+
+class FsckCmd(cmd.Cmd):
+
+
+    def __init__(self, args):
+        
+        #
+        cmd.Cmd.__init__(self)
+
+        #
+        self.parse_arguments(args)
+
+    def parse_arguments(self, args):
+
+        #
+        parser = argparse.ArgumentParser(
+            prog=' '.join(args[0:2]), 
+            description='Check data files, e.g., after scarphase-profile '
+                        'was killed, and optionally repair them.'
+            )
+
+        parser.add_argument(
+            "datafiles",
+            nargs='+',
+            help="Thread data files, i.e., <profile>.<tid>."
+            )
+
+        #
+        group = parser.add_mutually_exclusive_group()
+
+        group.add_argument(
+            "--truncate",
+            action='store_true',
+            help="Cut off the file after the last good window."
+            )
+
+        group.add_argument(
+            "--rewrite",
+            action='store_true',
+            help="Write the good windows to a new file, which replaces it."
+            )
+
+        #
+        parser.add_argument(
+            "--checksums",
+            action='store_true',
+            help="Add window checksums when rewriting."
+            )
+
+        parser.add_argument(
+            "--compression",
+            choices=sorted(pyscarphase.proto.data.COMPRESSION.keys()),
+            help="Compress windows when rewriting."
+            )
+
+        parser.add_argument(
+            "--no-verify",
+            dest='verify',
+            action='store_false',
+            help="Do not verify window checksums."
+            )
+
+        self.args = parser.parse_args(args[2:])
+
+        if (self.args.checksums or self.args.compression) \
+                and not self.args.rewrite:
+            parser.error('--checksums and --compression require --rewrite')
+
+        if self.args.checksums and self.args.compression:
+            parser.error('--checksums can not be used with --compression')
+
+    def run(self):
+
+        # Table
+        table = prettytable.PrettyTable(
+            ["Filename", 
+             "Version", 
+             "Windows", 
+             "Size", 
+             "Lost", 
+             "Status"
+             ]
+            )
+        table.align["Filename"] = "l"
+        table.align["Status"] = "l"
+
+        for filename in self.args.datafiles:
+
+            # Skip sidecars
+            if os.path.isdir(filename) or \
+                    any(fnmatch.fnmatch(filename, p) for p in SIDECARS):
+                continue
+
+            try:
+                result = pyscarphase.proto.data.check(
+                    filename, checksums=self.args.verify)
+            except (IOError, OSError) as e:
+                table.add_row(
+                    [filename, None, None, None, None, e.strerror or str(e)])
+                continue
+
+            status = result.error or 'ok'
+
+            if result.version is not None:
+                try:
+                    if self.args.truncate and result.end != result.size:
+                        self.__truncate(filename, result)
+                        status += ', truncated'
+
+                    if self.args.rewrite:
+                        self.__rewrite(filename, result)
+                        status += ', rewritten'
+
+                except (IOError, OSError) as e:
+                    status += ', %s' % (e.strerror or str(e))
+
+            # Add data
+            table.add_row(
+                [filename, 
+                 result.version, 
+                 result.windows, 
+                 result.size, 
+                 result.size - result.end, 
+                 status
+                 ]
+                )
+
+        # Print table
+        print(table)
+
+    def __truncate(self, filename, result):
+
+        with open(filename, 'r+b') as f:
+            f.truncate(result.end)
+
+        # The index does not match the file anymore
+        index = pyscarphase.proto.index.index_filename(filename)
+
+        if os.path.exists(index):
+            os.unlink(index)
+
+    def __rewrite(self, filename, result):
+
+        # With --no-verify, windows with bad checksums are copied too
+        reader = pyscarphase.proto.data.DataReader(
+            filename, index=False, verify=self.args.verify)
+
+        uuid = None
+        if reader.header.HasField('uuid'):
+            uuid = reader.header.uuid
+
+        # Only the windows before the first error
+        with pyscarphase.proto.data.DataWriter(
+                filename, uuid, 
+                compression=self.args.compression,
+                checksums=self.args.checksums) as writer:
+
+            for window in itertools.islice(reader, result.windows):
+                writer.write(window)
+
+def run(args): 
+    FsckCmd(args).run();
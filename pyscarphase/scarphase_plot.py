@@ -36,7 +36,12 @@ import matplotlib.pyplot as plt
 import pyscarphase.proto.meta
 import pyscarphase.proto.data
 
+import pyscarphase.util.columns
+import pyscarphase.util.demultiplexer
+
 import pyscarphase.plot.phasebar
+import pyscarphase.plot.decimate
+import pyscarphase.plot.heatmap
 
 import pyscarphase.cmd
 
@@ -94,6 +99,20 @@ class PlotCmd(pyscarphase.cmd.Cmd):
                 'signatures',
                 help="Plot signatures")
 
+            sub_parser.add_argument(
+                "--rasterize",
+                choices=sorted(pyscarphase.plot.heatmap.REDUCE.keys()),
+                default=None,
+                help="Reduce the windows to one image column per pixel, "
+                     "with the mean or max signature."
+                )
+
+            sub_parser.add_argument(
+                "--retile",
+                action='store_true',
+                help="Rasterize the visible windows again when zooming."
+                )
+
             # 
             sub_parser.set_defaults(func=self.plot_signatures)
             
@@ -107,14 +126,50 @@ class PlotCmd(pyscarphase.cmd.Cmd):
                 'windows',
                 help="Plot windows")
 
+            sub_parser.add_argument(
+                "--demux",
+                choices=sorted(
+                    pyscarphase.util.demultiplexer.STRATEGIES.keys()), 
+                default="average",
+                help="How to fill in counters that were not sampled."
+                )
+
             # 
             sub_parser.set_defaults(func=self.plot_windows)
             
             # 
             add_common_args(sub_parser)
 
+        def conf_plot_live():
+
+            # Add new parser
+            sub_parser = subparsers.add_parser(
+                'live',
+                help="Plot windows while the data file is being written")
+
+            sub_parser.add_argument(
+                "datafile",
+                help="Thread data file, i.e., <profile>.<tid>."
+                )
+
+            sub_parser.add_argument(
+                "--counters", "-c",
+                type=str, default="",
+                help="Performance counter ids."
+                )  
+
+            sub_parser.add_argument(
+                "--interval", "-i",
+                type=float, default=1.0,
+                help="Poll interval in seconds."
+                )
+
+            # 
+            sub_parser.set_defaults(func=self.plot_live)
+
         conf_plot_signatures()
         conf_plot_windows()
+        conf_plot_live()
 
         #
         self.args = self.parser.parse_args(args[2:])
@@ -132,20 +187,13 @@ class PlotCmd(pyscarphase.cmd.Cmd):
 
         thread = profile.threads[self.args.thread]
 
-        reader = pyscarphase.proto.data.DataReader(thread.profile.filename, 
-                                 uuid=thread.profile.uuid)
+        columns = pyscarphase.util.columns.load_columns(
+            thread.profile.filename, 
+            uuid=thread.profile.uuid
+            )
+
+        phase_list = columns.phase
 
-        phase_list = []
-        signatures = []
-        for w in reader:
-            phase_list.append(w.phase_info.phase)
-            signatures.append(w.phase_info.signature.fv_values[:])
-       
-        import numpy as np
-        signatures = np.array(signatures)
-        signatures = signatures.transpose()
-
-       
         #
         if len(phase_list) == 0:
             print("Aborting, nothing to plot (ie, no windows in thread)!")
@@ -159,11 +207,19 @@ class PlotCmd(pyscarphase.cmd.Cmd):
 
             pyscarphase.plot.phasebar.plot(pbar_ax, plot_ax, phase_list)
     
-            # Plot counter values
-            plot_ax.imshow(signatures, 
-                  aspect='auto', 
-                  interpolation='nearest', 
-                  cmap=matplotlib.cm.binary)
+            # Plot signatures
+            if self.args.rasterize:
+                pyscarphase.plot.heatmap.Heatmap(
+                    plot_ax, 
+                    columns.signature,
+                    reduce=self.args.rasterize,
+                    retile=self.args.retile
+                    )
+            else:
+                plot_ax.imshow(columns.signature.transpose(), 
+                      aspect='auto', 
+                      interpolation='nearest', 
+                      cmap=matplotlib.cm.binary)
 
 
             # 
@@ -184,12 +240,6 @@ class PlotCmd(pyscarphase.cmd.Cmd):
         #
         thread = profile.threads[self.args.thread]
 
-        #
-        reader = pyscarphase.proto.data.DataReader(
-            thread.profile.filename, 
-            uuid=thread.profile.uuid
-            )
-
         #
         counters = [ int(c) for c in self.args.counters.split() ]
 
@@ -203,20 +253,18 @@ class PlotCmd(pyscarphase.cmd.Cmd):
 
         def retrieve_data():
 
-            import util.counter
-            import util.demultiplexer
-
-            dm = util.demultiplexer.Demultiplexer(reader)
+            # All counters of all windows, cached next to the data file
+            pids, values = pyscarphase.util.demultiplexer.load_counters(
+                thread.profile.filename, 
+                thread.profile.uuid,
+                profile.performance_counters,
+                self.args.demux
+                )
 
-            for w in dm.read():
-                phase_list.append(w.phase)
-            
-                for c in counters:
-                    v = util.counter.exec_func(
-                        c, profile.performance_counters, w
-                        )
+            phase_list.extend(pids.tolist())
 
-                    samples[c].append(v)
+            for c in counters:
+                samples[c] = values[:, c]
 
         #
         retrieve_data()
@@ -234,9 +282,12 @@ class PlotCmd(pyscarphase.cmd.Cmd):
 
             pyscarphase.plot.phasebar.plot(pbar_ax, plot_ax, phase_list)
     
-            # Plot counter values
+            # Plot counter values, decimated to the resolution of the plot
             for c in counters:
-                plot_ax.plot(samples[c], label=profile.performance_counters[c].name)
+                pyscarphase.plot.decimate.plot(
+                    plot_ax, samples[c], 
+                    label=profile.performance_counters[c].name
+                    )
 
             plot_ax.legend()
 
@@ -250,6 +301,85 @@ class PlotCmd(pyscarphase.cmd.Cmd):
         _plot()
 
 
+    def plot_live(self):
+
+        #
+        reader = pyscarphase.proto.data.open_live(
+            self.args.datafile,
+            interval=self.args.interval
+            )
+
+        #
+        counters = [ int(c) for c in self.args.counters.split() ]
+
+        #
+        phase_list = []
+
+        # Raw samples, (window, value), the rest of the trace is unknown
+        samples = {}
+        for c in counters:
+            samples[c] = ([], [])
+
+        # Create axis
+        pbar_ax = plt.axes([0.1, 0.9, 0.8, 0.025])
+        plot_ax = plt.axes([0.1, 0.1, 0.8, 0.75])
+
+        lines = {}
+        for c in counters:
+            lines[c] = plot_ax.plot([], [], '.', label='%i' % (c))[0]
+
+        if counters:
+            plot_ax.legend()
+
+        class Updater:
+
+            def __init__(self):
+                self.cid = None
+
+            def __call__(self):
+
+                # Only read the new windows
+                windows = reader.poll()
+
+                if not windows:
+                    return
+
+                for w in windows:
+                    for s in w.perf_samples:
+                        if s.cid in samples:
+                            samples[s.cid][0].append(len(phase_list))
+                            samples[s.cid][1].append(s.value)
+
+                    phase_list.append(w.phase_info.phase)
+
+                for c in counters:
+                    lines[c].set_data(*samples[c])
+
+                # Redraw phase bar
+                if self.cid is not None:
+                    plot_ax.callbacks.disconnect(self.cid)
+
+                pbar_ax.cla()
+                self.cid = pyscarphase.plot.phasebar.plot(
+                    pbar_ax, plot_ax, phase_list)
+
+                plot_ax.set_xlim(0, len(phase_list))
+                plot_ax.relim()
+                plot_ax.autoscale_view(scalex=False)
+
+                plt.draw()
+
+        update = Updater()
+        update()
+
+        timer = plt.gcf().canvas.new_timer(
+            interval=int(self.args.interval * 1000))
+        timer.add_callback(update)
+        timer.start()
+
+        plt.show()
+
+
 def run(args):
     PlotCmd(args).run()
 
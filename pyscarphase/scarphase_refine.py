@@ -29,11 +29,14 @@
 # Authors: Andreas Sembrant
 
 import sys, argparse
+import numpy as np
 
 import pyscarphase.proto.meta
 import pyscarphase.proto.data
 
+import pyscarphase.util.columns
 import pyscarphase.util.progress
+import pyscarphase.util.demultiplexer
 
 import pyscarphase.cmd
 
@@ -73,6 +76,12 @@ class RefineCmd(pyscarphase.cmd.Cmd):
                 help="Output file"
                 )
 
+            parser.add_argument(
+                "--compression",
+                choices=sorted(pyscarphase.proto.data.COMPRESSION.keys()),
+                help="Write compressed data files"
+                )
+
         def conf_refine_classification():
 
             # Add new parser
@@ -120,37 +129,43 @@ class RefineCmd(pyscarphase.cmd.Cmd):
             readers.append(
                 pyscarphase.proto.data.DataReader(
                     thread.profile.filename, 
-                    uuid=thread.profile.uuid
+                    uuid=thread.profile.uuid,
+                    use_mmap=True
                     )
                 )
 
-            tmpfile = '%s_' % (thread.profile.filename)
+            filename = thread.profile.filename
+            if self.args.output:
+                filename = '%s<%i>' % (self.args.output, thread.tid)
 
+            # Written to a tmp file, moved into place when closed
             writers.append(
                 pyscarphase.proto.data.DataWriter(
-                    tmpfile, 
-                    uuid=thread.profile.uuid
+                    filename, 
+                    uuid=thread.profile.uuid,
+                    compression=self.args.compression
                     )
                 )
 
         # Refine
-        self._refine_classification(
-            readers, 
-            writers, 
-            k = self.args.k, 
-            max_iter = self.args.max_iter)
+        try:
+            self._refine_classification(
+                readers, 
+                writers, 
+                k = self.args.k, 
+                max_iter = self.args.max_iter)
+        except:
+            for writer in writers:
+                writer.abort()
+            raise
 
         # Move tmp files to final dest
-        import shutil
-        for thread in profile.threads:
-
-            tmpfile = '%s_' % (thread.profile.filename)
-
-            if self.args.output:
-                thread.profile.filename = '%s<%i>' % (self.args.output, 
-                                                      thread.tid)
+        for thread, writer in zip(profile.threads, writers):
+            thread.profile.no_windows = writer.close()
+            thread.profile.filename = writer.filename
 
-            shutil.move(tmpfile, thread.profile.filename)
+            # The phases have changed
+            pyscarphase.util.demultiplexer.clear_cache(writer.filename)
 
         pyscarphase.proto.meta.save_profile(profile, self.args.output)
 
@@ -159,62 +174,50 @@ class RefineCmd(pyscarphase.cmd.Cmd):
 
         from sklearn.cluster import MiniBatchKMeans
 
-        if k == None:
-            phase_set = set()
-
-            pyscarphase.util.progress.start(
-                'Examing existing phase clusters:', 
-                max_value = len(readers)
-                )
-
-            for i, reader in enumerate(readers):
-                pyscarphase.util.progress.update(i + 1)
-
-                # Find all phases
-                for w in reader:
-                    phase_set.add(w.phase_info.phase)
-
-                # Reset reader
-                reader.seek(0)
-
-            k = len(phase_set)
-            pyscarphase.util.progress.stop()
-
-
-        def _get_batches(readers, size=k):
-            batch = []
-
-            for reader in readers:
-                while True:
-                    try:
-                        wd = reader.next()
-                        batch.append(wd.phase_info.signature.fv_values[:])
+        # Gather the signatures and phases of all threads in one pass, the
+        # columns are memory mapped and cached next to the data files
+        pyscarphase.util.progress.start(
+            'Loading signatures:', 
+            max_value = len(readers)
+            )
 
-                        if len(batch) == size:
-                            yield batch
-                            batch = []
+        columns = []
+        for i, reader in enumerate(readers):
+            pyscarphase.util.progress.update(i + 1)
 
-                    except StopIteration:
-                        reader.seek(0)
-                        break
+            columns.append(
+                pyscarphase.util.columns.load_columns(
+                    reader.filename, 
+                    uuid=reader.header.uuid
+                    )
+                )
 
-            yield batch
+        pyscarphase.util.progress.stop()
 
+        signatures = np.concatenate(
+            [ np.asarray(c.signature, dtype=np.float64) for c in columns ])
 
+        if k == None:
+            k = len(np.unique(
+                np.concatenate([ np.asarray(c.phase) for c in columns ])))
 
-        km = MiniBatchKMeans(k=k, init='k-means++')
+        #
+        km = MiniBatchKMeans(n_clusters=k, init='k-means++')
 
         pyscarphase.util.progress.start(
             'Refining phase clusters:',
             max_value = max_iter
             )
 
-
         for iteration in range(max_iter):
             pyscarphase.util.progress.update(iteration + 1)
 
-            for batch in _get_batches(readers, km.batch_size):
-                km.partial_fit(batch)
+            # Shuffled batches
+            order = np.random.permutation(len(signatures))
+
+            for start in xrange(0, len(order), km.batch_size):
+                km.partial_fit(
+                    signatures[order[start:start + km.batch_size]])
 
         pyscarphase.util.progress.stop()
 
@@ -225,15 +228,20 @@ class RefineCmd(pyscarphase.cmd.Cmd):
             max_value = len(readers)
             )
 
-        for i, (reader, writer) in enumerate(zip(readers, writers)):
+        for i, (reader, writer, c) in \
+                enumerate(zip(readers, writers, columns)):
             pyscarphase.util.progress.update(i + 1)
 
-            # Find all phases
-            for w in reader:
+            # Classify all windows of the thread at once
+            phases = []
+            if len(c):
+                phases = km.predict(
+                    np.asarray(c.signature, dtype=np.float64)).tolist()
+
+            for w, phase in zip(reader, phases):
 
                 # Reclassify
-                w.phase_info.phase = \
-                    int(km.predict([w.phase_info.signature.fv_values])[0])
+                w.phase_info.phase = int(phase)
 
                 # Invalidate predictions
                 w.phase_info.ClearField('prediction')
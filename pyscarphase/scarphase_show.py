@@ -134,12 +134,35 @@ class ShowCmd(cmd.Cmd):
             #
             add_common_args(sub_parser)
 
+        def conf_show_live():
+
+            #
+            sub_parser = subparsers.add_parser(
+                'live',
+                help="Show phases while the data file is being written"
+                )
+
+            sub_parser.add_argument(
+                "datafile",
+                help="Thread data file, i.e., <profile>.<tid>."
+                )
+
+            sub_parser.add_argument(
+                "--interval", "-i",
+                type=float, default=1.0,
+                help="Poll interval in seconds."
+                )
+
+            #
+            sub_parser.set_defaults(func=self.show_live)
+
         #
         conf_show_settings()
         conf_show_system_variables()
         conf_show_threads()
         conf_show_counters()
         conf_show_processes()
+        conf_show_live()
 
         self.args = parser.parse_args(args[2:])
 
@@ -280,5 +303,76 @@ class ShowCmd(cmd.Cmd):
         # Print table
         print(table)
 
+    def show_live(self):
+
+        import time
+
+        # Only the phase info is needed
+        reader = pyscarphase.proto.data.open_live(
+            self.args.datafile,
+            interval=self.args.interval,
+            fields=[ 'phase_info' ]
+            )
+
+        # pid -> [ no. windows, no. instances ]
+        phases = {}
+
+        no_windows, last_pid = 0, None
+
+        try:
+            while True:
+                windows = reader.poll()
+
+                if not windows:
+                    time.sleep(self.args.interval)
+                    continue
+
+                # Update statistics with the new windows only
+                for w in windows:
+                    pid = w.phase_info.phase
+
+                    if not pid in phases:
+                        phases[pid] = [ 0, 0 ]
+
+                    phases[pid][0] += 1
+
+                    if pid != last_pid:
+                        phases[pid][1] += 1
+
+                    no_windows += 1
+                    last_pid = pid
+
+                # Table
+                table = prettytable.PrettyTable(
+                    ["PID", 
+                     "Windows", 
+                     "Coverage", 
+                     "Instances"
+                     ]
+                    )
+
+                # Add data
+                for pid, (count, instances) in sorted(
+                        phases.iteritems(), 
+                        key=lambda x: x[1][0], 
+                        reverse=True):
+                    table.add_row(
+                        [pid, 
+                         count, 
+                         '%.1f%%' % (100.0 * count / no_windows), 
+                         instances
+                         ]
+                        )
+
+                # Print table
+                print("windows=%i phases=%i current=%i" % (
+                        no_windows, len(phases), last_pid))
+                print(table)
+
+                time.sleep(self.args.interval)
+
+        except KeyboardInterrupt:
+            pass
+
 def run(args): 
     ShowCmd(args).run();
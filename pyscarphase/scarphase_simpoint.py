@@ -28,13 +28,17 @@
 #
 # Authors: Andreas Sembrant
 
+import heapq
 import argparse
+import multiprocessing
 import numpy as np
 import scipy.spatial.distance as spd
 
 import pyscarphase.proto.meta
 import pyscarphase.proto.data
 
+import pyscarphase.util.columns
+
 import cmd
 
 class SimpointCmd(cmd.Cmd):
@@ -80,6 +84,50 @@ class SimpointCmd(cmd.Cmd):
                 help="Phase coverage in precentage."
                 )
 
+            parser.add_argument(
+                "--alternates", "-a",
+                type=int, default=0,
+                help="Alternative windows to list per phase."
+                )
+
+            parser.add_argument(
+                "--all-threads",
+                dest="all_threads",
+                action="store_true", default=False,
+                help="Find simulation points of all threads, and merge them."
+                )
+
+            parser.add_argument(
+                "--jobs", "-j",
+                type=int, default=None,
+                help="Worker processes (default: number of CPUs)."
+                )
+
+            parser.add_argument(
+                "--cluster",
+                action="store_true", default=False,
+                help="Merge similar phases of different threads with "
+                     "--all-threads."
+                )
+
+            parser.add_argument(
+                "--cluster-threshold",
+                dest="cluster_threshold",
+                type=float, default=0.1,
+                help="Largest centroid distance, relative to the centroid's "
+                     "1-norm, of merged phases."
+                )
+
+        #
+        def add_stream_args(parser):
+
+            parser.add_argument(
+                "--stream",
+                action="store_true", default=False,
+                help="Stream the profile, only keep per phase "
+                     "statistics in memory."
+                )
+
         #
         def conf_find():
 
@@ -93,6 +141,20 @@ class SimpointCmd(cmd.Cmd):
             
             # 
             add_common_args(sub_parser)
+            add_stream_args(sub_parser)
+
+            sub_parser.add_argument(
+                "--candidates",
+                type=int, default=16,
+                help="Candidate windows to keep per phase when streaming."
+                )
+
+            sub_parser.add_argument(
+                "--rerank",
+                action="store_true", default=False,
+                help="Rank all windows against the final centroids in a "
+                     "second pass when streaming."
+                )
          
         #
         def conf_find_first():
@@ -107,10 +169,68 @@ class SimpointCmd(cmd.Cmd):
             
             # 
             add_common_args(sub_parser)
+            add_stream_args(sub_parser)
+
+        #
+        def conf_find_kmeans():
+
+            # Add new parser
+            sub_parser = subparsers.add_parser(
+                'find-kmeans',
+                help="Find simulation points, k-means clustering of "
+                     "the windows")
+
+            # 
+            sub_parser.set_defaults(func=self.find_kmeans_simpoints)
+            
+            # 
+            add_common_args(sub_parser)
+
+            sub_parser.add_argument(
+                "--min-k",
+                dest="min_k",
+                type=int, default=1,
+                help="Smallest number of clusters to try."
+                )
+
+            sub_parser.add_argument(
+                "--max-k", "-k",
+                dest="max_k",
+                type=int, default=30,
+                help="Largest number of clusters to try."
+                )
+
+            sub_parser.add_argument(
+                "--dims",
+                type=int, default=0,
+                help="Randomly project the signatures to this many "
+                     "dimensions first (default: no projection)."
+                )
+
+            sub_parser.add_argument(
+                "--bic-threshold",
+                dest="bic_threshold",
+                type=float, default=0.9,
+                help="Pick the smallest k whose BIC score reaches this "
+                     "fraction of the range of scores."
+                )
+
+            sub_parser.add_argument(
+                "--restarts",
+                type=int, default=5,
+                help="k-means runs with different seeds, per k."
+                )
+
+            sub_parser.add_argument(
+                "--seed",
+                type=int, default=1,
+                help="Random seed."
+                )
 
         #
         conf_find()
         conf_find_first()
+        conf_find_kmeans()
 
         self.args = parser.parse_args(args[2:])
 
@@ -121,88 +241,284 @@ class SimpointCmd(cmd.Cmd):
         
         def __init__(self, pid):
             self.pid = pid
+            self.weight = 0
             self.windows = []
             self.centroid = []
+            self.distances = []
+
+    class PhaseStats:
+        '''
+        Running statistics of a phase, and a bounded heap of its best
+        candidate windows.
+        '''
+
+        def __init__(self, pid, no_candidates):
+            self.pid = pid
+            self.weight = 0
+            self.total = 0.0
+            self.centroid = None
+            self.no_candidates = no_candidates
+
+            # <offset, size> of the first windows
+            self.firsts = []
+
+            # <-distance, -window, offset, size, signature>, worst first
+            self.candidates = []
+
+        def mean(self):
+            return self.total / self.weight
+
+        def add(self, window, offset, size, signature, score=True):
+
+            #
+            if score:
+                # Score against the mean of the windows seen so far
+                if self.weight == 0:
+                    distance = np.inf
+                else:
+                    distance = _cityblock(signature, self.mean())
+
+                self.push(distance, window, offset, size, signature)
+
+            elif len(self.firsts) < self.no_candidates:
+                self.firsts.append((offset, size))
+
+            #
+            self.total = self.total + signature
+            self.weight += 1
+
+        def push(self, distance, window, offset, size, signature=None):
+
+            # Ties are broken in favor of earlier windows
+            item = (-distance, -window, offset, size, signature)
+
+            if len(self.candidates) < self.no_candidates:
+                heapq.heappush(self.candidates, item)
+            elif item[:2] > self.candidates[0][:2]:
+                heapq.heapreplace(self.candidates, item)
+
+        def rescore(self):
+            '''Rank the candidates against the final centroid.'''
+
+            self.candidates = [ 
+                (-_cityblock(signature, self.centroid), 
+                 w, offset, size, signature)
+                for _, w, offset, size, signature in self.candidates
+                ]
+
+            heapq.heapify(self.candidates)
+
+        def reset(self, no_candidates):
+            self.no_candidates = no_candidates
+            self.candidates = []
+
+        def windows(self, k):
+            '''The <offset, size> of the k best candidates, best first.'''
+
+            best = heapq.nlargest(
+                k, self.candidates, key=lambda item: item[:2])
+
+            return [ (offset, size) for _, _, offset, size, _ in best ]
+
+    def __load_thread(self):
 
-    def _build_phase_data(self):
-        
         profile = pyscarphase.proto.meta.load_profile(self.args.profile)
 
-        thread = profile.threads[self.args.thread]
+        return profile.threads[self.args.thread]
+
+    def __read_windows(self, thread):
+        '''
+        Iterate over the <window, offset, size, phase, signature> of each
+        window, only a bounded number of window offsets are kept in memory.
+        '''
 
         reader = pyscarphase.proto.data.DataReader(
-            thread.profile.filename, 
-            uuid=thread.profile.uuid
+            thread.profile.filename,
+            uuid=thread.profile.uuid,
+            index=False,
+            use_mmap=True,
+            fields=[ 'size', 'phase_info' ],
+            max_offsets=4096
             )
-        
-        phases = {}
-        for w in reader:
-    
-            #
-            pid = w.phase_info.phase
-               
-            #
-            if not pid in phases:
-                phases[pid] = self.Phase(pid)
-                phases[pid].centroid = \
-                    np.zeros(len(w.phase_info.signature.fv_values))
-    
-            #
-            phases[pid].centroid = \
-                np.add(
-                    phases[pid].centroid, 
-                    w.phase_info.signature.fv_values[:]
-                    )
-
-        # Normalize centroid
-        for p in phases.itervalues():
-            p.centroid = np.linalg.norm(p.centroid, 1)          
-            
-        # Do second pass
-        reader.seek(0)
+
+        # Signature dimension, same as the first window
+        no_dims = None
+
         offset = 0
-        for w in reader:
-    
-            #
-            pid = w.phase_info.phase
-            
-            # Calc distance
-            d = spd.cityblock(
-                phases[pid].centroid, 
-                w.phase_info.signature.fv_values[:]
-                )
+        for i, w in enumerate(reader):
 
             #
-            phases[pid].windows.append((offset, w.size, d))
-            
-            #
+            fv_values = w.phase_info.signature.fv_values
+
+            if no_dims is None:
+                no_dims = len(fv_values)
+
+            signature = np.zeros(no_dims)
+            signature[:min(no_dims, len(fv_values))] = fv_values[:no_dims]
+
+            yield i, offset, w.size, w.phase_info.phase, signature
+
             offset += w.size
-            
-        # Order phases in descending length
-        phases = sorted(
-            phases.itervalues(), 
-            key=lambda p: len(p.windows), 
-            reverse=True
-            )
-        
+
+    def _stream_phase_data(self, k, score=True):
+        '''
+        Group the windows by phase in one pass over the profile, keeping
+        only each phase's running signature sum and candidate windows.
+
+        Windows are scored against the mean of the phase's preceding
+        windows, the candidates are then ranked against the final
+        centroid. With --rerank, all windows are ranked against the final
+        centroids in a second pass instead. If score is False, the first k
+        windows of each phase are kept.
+        '''
+
+        thread = self.__load_thread()
+
+        if score:
+            no_candidates = max(k, self.args.candidates)
+        else:
+            no_candidates = k
+
         #
-        return phases
+        stats = {}
+        for i, offset, size, pid, signature in self.__read_windows(thread):
+
+            #
+            p = stats.get(pid)
+            if p is None:
+                p = stats[pid] = self.PhaseStats(pid, no_candidates)
+
+            p.add(i, offset, size, signature, score)
 
-    def _find_simpoints(self, wfunc):
+        for p in stats.itervalues():
+            p.centroid = p.mean()
 
         #
-        phases = self._build_phase_data()
-                  
+        if score and self.args.rerank:
+
+            for p in stats.itervalues():
+                p.reset(k)
+
+            for i, offset, size, pid, signature in self.__read_windows(thread):
+
+                #
+                p = stats[pid]
+                p.push(_cityblock(signature, p.centroid), i, offset, size)
+
+        elif score:
+
+            for p in stats.itervalues():
+                p.rescore()
+
+        # Order phases in descending length, same as _build_phase_data
+        phases = sorted(stats.itervalues(), key=lambda p: p.pid)
+
+        return sorted(phases, key=lambda p: p.weight, reverse=True)
+
+    def __load_columns(self):
+        '''
+        Load the columns of the thread, and set self.offsets and
+        self.sizes, the offset (in instructions) and size of each window.
+        '''
+        
+        thread = self.__load_thread()
+
+        columns = pyscarphase.util.columns.load_columns(
+            thread.profile.filename, 
+            uuid=thread.profile.uuid
+            )
+
+        self.sizes = np.asarray(columns.size)
+        self.offsets = np.cumsum(self.sizes) - self.sizes
+
+        return columns
+
+    def _build_phase_data(self):
+        '''
+        Group the windows by phase, and find each phase's centroid (mean
+        signature) and the Manhattan distance of its windows to it.
+        '''
+
+        columns = self.__load_columns()
+
+        # Read the trace once
+        phase_list = np.asarray(columns.phase)
+        signatures = np.asarray(columns.signature, dtype=np.float64)
+
+        return _group_phases(phase_list, signatures, 'cityblock')
+
+    def _kmeans_phase_data(self):
+        '''
+        Cluster the windows' signatures with k-means, SimPoint style, and
+        use the clusters as phases.
+
+        The signatures are optionally randomly projected to fewer
+        dimensions. k-means is run for each k in [min-k, max-k], in
+        parallel, and the smallest k whose BIC score reaches the threshold
+        is picked. The windows are ranked by their Euclidean distance to
+        the cluster centers.
+        '''
+
+        columns = self.__load_columns()
+
+        signatures = np.asarray(columns.signature, dtype=np.float64)
+
+        # Random projection
+        if self.args.dims > 0 and len(signatures):
+            projection = np.random.RandomState(self.args.seed).uniform(
+                -1.0, 1.0, size=(signatures.shape[1], self.args.dims))
+
+            signatures = np.dot(signatures, projection)
+
         #
-        if len(phases) == 0:
-            print("Aborting, nothing to plot (ie, no windows in thread)!")
-            exit()
+        ks = range(self.args.min_k, min(self.args.max_k, len(signatures)) + 1)
+
+        if len(ks) == 0:
+            return []
+
+        jobs = [ (k, self.args.restarts, self.args.seed) for k in ks ]
+
+        # Pool workers can't start their own workers, i.e., --all-threads
+        if multiprocessing.current_process().daemon:
+            _init_kmeans(signatures)
+            results = map(_kmeans, jobs)
+        else:
+            pool = multiprocessing.Pool(
+                self.args.jobs, _init_kmeans, (signatures,))
+            try:
+                results = pool.map(_kmeans, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        # Smallest k that reaches the threshold
+        scores = np.array([ bic for bic, _ in results ])
+
+        threshold = scores.min() + \
+            self.args.bic_threshold * (scores.max() - scores.min())
+
+        _, labels = results[np.flatnonzero(scores >= threshold)[0]]
+
+        return _group_phases(labels, signatures, 'euclidean')
+
+    def __windows(self, windows):
+        return zip(self.offsets[windows], self.sizes[windows])
+
+    def _select_simpoints(self, phases, wfunc):
+        '''
+        Pick simulation points from the largest phases until the coverage
+        is reached, wfunc returns the <offset, size> of a phase's
+        representative windows, best first.
+
+        Returns the number of windows, and a list of <pid, offset, size,
+        weight, alternates, centroid> in window order.
+        '''
 
         # 
-        no_windows = reduce(lambda y, p: len(p.windows) + y, phases, 0)
+        no_windows = reduce(lambda y, p: p.weight + y, phases, 0)
 
         # Convert to windows
-        self.args.coverage = self.args.coverage / 100.0 * no_windows
+        max_coverage = self.args.coverage / 100.0 * no_windows
 
         # Counter
         coverage = 0
@@ -214,56 +530,379 @@ class SimpointCmd(cmd.Cmd):
         for p in phases:
 
             #
-            coverage += len(p.windows)
+            coverage += p.weight
             
-            # Get window
-            w = wfunc(p)
+            # Get windows
+            windows = wfunc(p)
+            offset, size = windows[0]
           
-            # <window, weight>
-            simpoints.append((p.pid, w[0], w[1], len(p.windows)))
+            # <window, weight, alternates, centroid>
+            simpoints.append(
+                (p.pid, offset, size, p.weight, windows[1:], p.centroid))
 
             #
-            if coverage > self.args.coverage:
+            if coverage > max_coverage:
                 break
 
-        #
-        coverage = 0
+        # Sort in window order
+        return no_windows, sorted(simpoints, key=lambda x: x[1])
+
+    def _thread_simpoints(self, method='center'):
+        '''
+        Find the simulation points of self.args.thread, the windows closest
+        to the phase centroids ('center'), the first windows of the phases
+        ('first'), or the windows closest to the k-means cluster centers
+        ('kmeans').
+        '''
+
+        k = self.args.alternates + 1
+
+        first = method == 'first'
+
+        if method == 'kmeans':
+
+            def select_windows(p):
+                closest = np.argsort(p.distances, kind='mergesort')[:k]
+                return self.__windows(p.windows[closest])
+
+            phases = self._kmeans_phase_data()
+
+        elif first and self.args.stream:
+
+            def select_windows(p):
+                return p.firsts
+
+            phases = self._stream_phase_data(k, score=False)
+
+        elif first:
+
+            def select_windows(p):
+                return self.__windows(p.windows[:k])
+
+            phases = self._build_phase_data()
+
+        elif self.args.stream:
             
+            def select_windows(p):
+                return p.windows(k)
+
+            phases = self._stream_phase_data(k)
+
+        else:
+
+            def select_windows(p):
+                closest = np.argsort(p.distances, kind='mergesort')[:k]
+                return self.__windows(p.windows[closest])
+
+            phases = self._build_phase_data()
+
+        return self._select_simpoints(phases, select_windows)
+
+    def __simpoint(self, pid, offset, duration, weight, alternates):
+
+        simpoint = {"pid": pid, 
+                    "offset" : long(offset), 
+                    "duration": long(duration),
+                    "weight" : weight
+                    }
+
+        if self.args.alternates > 0:
+            simpoint["alternates"] = [ 
+                {"offset": long(o), "duration": long(d)} 
+                for o, d in alternates 
+                ]
+
+        return simpoint
+
+    def _find_simpoints(self, method='center'):
+
         #
-        for pid, offset, duration, weight in simpoints:
-            coverage += weight
-            
-        # Sort in window order
-        simpoints = sorted(simpoints, key=lambda x: x[1])
+        if self.args.all_threads:
+            self._find_all_simpoints(method)
+            return
+
+        #
+        _, simpoints = self._thread_simpoints(method)
+                  
+        #
+        if len(simpoints) == 0:
+            print("Aborting, nothing to plot (ie, no windows in thread)!")
+            exit()
 
         #
         _simpoints = []
         
         #
-        for pid, offset, duration, weight in simpoints:
-            _simpoints.append({"pid": pid, 
-                               "offset" : long(offset), 
-                               "duration": long(duration),
-                               "weight" : weight
-                               })
+        for pid, offset, duration, weight, alternates, _ in simpoints:
+            _simpoints.append(
+                self.__simpoint(pid, offset, duration, weight, alternates))
                                
         import json
         print json.dumps({"simpoints" : _simpoints}, indent=2)
+
+    def _find_all_simpoints(self, method='center'):
+        '''
+        Find the simulation points of all threads, one thread per worker
+        process, and merge them.
+        '''
+
+        profile = pyscarphase.proto.meta.load_profile(self.args.profile)
+
+        #
+        jobs = [ (self, i, method) for i in xrange(len(profile.threads)) ]
+
+        pool = multiprocessing.Pool(self.args.jobs)
+        try:
+            results = pool.map(_thread_simpoints, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        # 
+        total_windows = sum(no_windows for no_windows, _ in results)
+
+        if total_windows == 0:
+            print("Aborting, nothing to plot (ie, no windows in profile)!")
+            exit()
+
+        #
+        _threads = []
+        _simpoints = []
+
+        for i, (no_windows, simpoints) in enumerate(results):
+
+            #
+            thread = profile.threads[i]
+
+            _threads.append({"thread": i,
+                             "tid": thread.tid,
+                             "process": thread.process,
+                             "windows": no_windows
+                             })
+
+            #
+            for pid, offset, duration, weight, alternates, _ in simpoints:
+
+                simpoint = self.__simpoint(
+                    pid, offset, duration, weight, alternates)
+
+                simpoint["thread"] = i
+                simpoint["thread_weight"] = float(weight) / no_windows
+                simpoint["global_weight"] = float(weight) / total_windows
+
+                _simpoints.append(simpoint)
+
+        #
+        if self.args.cluster:
+            _simpoints = _cluster_simpoints(
+                _simpoints, 
+                [ centroid for _, simpoints in results 
+                  for _, _, _, _, _, centroid in simpoints ],
+                self.args.cluster_threshold
+                )
+        
+        import json
+        print json.dumps(
+            {"threads": _threads, "simpoints" : _simpoints}, indent=2)
             
     def find_simpoints(self):
-        
-        def select_center_window(p):
-            return min(p.windows, key=lambda x: x[2])
-        
-        self._find_simpoints(select_center_window)
+        self._find_simpoints()
         
     def find_first_simpoints(self):
+        self._find_simpoints('first')
+
+    def find_kmeans_simpoints(self):
+        self._find_simpoints('kmeans')
+
+    def __getstate__(self):
+
+        # Sent to the worker processes, the subcommand can't be pickled
+        state = dict(self.__dict__)
+        state['args'] = argparse.Namespace(**vars(self.args))
+        state['args'].func = None
+
+        return state
         
-        def select_first_window(p):
-            return p.windows[0]
-        
-        self._find_simpoints(select_first_window)
+
+def _group_phases(phase_list, signatures, metric):
+    '''
+    Group the windows by phase, and find each phase's centroid (mean
+    signature) and the distance of its windows to it.
+
+    Returns the phases in descending length.
+    '''
+
+    # Group windows by phase, in window order
+    order = np.argsort(phase_list, kind='mergesort')
+
+    pids, bounds = np.unique(phase_list[order], return_index=True)
+    bounds = np.append(bounds, len(order))
+
+    # Mean signature of each phase
+    centroids = np.add.reduceat(
+        signatures[order], bounds[:-1], axis=0
+        ) if len(order) else np.zeros((0, signatures.shape[1]))
+
+    centroids /= np.diff(bounds)[:, np.newaxis]
+
+    phases = []
+    for i, pid in enumerate(pids.tolist()):
         
+        #
+        p = SimpointCmd.Phase(pid)
+
+        p.windows  = order[bounds[i]:bounds[i + 1]]
+        p.weight   = len(p.windows)
+        p.centroid = centroids[i]
+
+        # Calc distances
+        p.distances = spd.cdist(
+            signatures[p.windows], 
+            p.centroid[np.newaxis], 
+            metric
+            )[:, 0]
+
+        phases.append(p)
+
+    # Order phases in descending length
+    phases = sorted(
+        phases, 
+        key=lambda p: len(p.windows), 
+        reverse=True
+        )
+    
+    #
+    return phases
+
+def _thread_simpoints(job):
+    '''Find the simulation points of one thread, in a worker process.'''
+
+    cmd, thread, method = job
+
+    cmd.args.thread = thread
+
+    return cmd._thread_simpoints(method)
+
+# The signatures to cluster, set in each worker process
+_signatures = None
+
+def _init_kmeans(signatures):
+    global _signatures
+    _signatures = signatures
+
+def _kmeans(job):
+    '''
+    Cluster the signatures into k clusters, in a worker process.
+
+    Returns the BIC score of the clustering, and the cluster of each
+    window. The score is that of X-means (Pelleg and Moore), which SimPoint
+    uses, i.e., the log-likelihood of the data under identical spherical
+    Gaussians, penalized by the number of parameters.
+    '''
+
+    from sklearn.cluster import KMeans
+
+    k, restarts, seed = job
+
+    #
+    kmeans = KMeans(
+        n_clusters=k, 
+        n_init=restarts, 
+        random_state=seed
+        ).fit(_signatures)
+
+    labels = kmeans.labels_.astype(np.int32)
+
+    #
+    R, M = _signatures.shape
+
+    variance = kmeans.inertia_ / max(M * (R - k), 1)
+
+    sizes = np.bincount(labels, minlength=k).astype(np.float64)
+    sizes = sizes[sizes > 0]
+
+    if variance > 0:
+        log_variance = np.log(variance)
+    else:
+        log_variance = np.log(np.finfo(np.float64).tiny)
+
+    likelihood = np.sum(
+        sizes * np.log(sizes) 
+        - sizes * np.log(R)
+        - sizes / 2.0 * np.log(2 * np.pi)
+        - sizes * M / 2.0 * log_variance
+        - (sizes - k) / 2.0
+        )
+
+    parameters = (k - 1) + M * k + 1
+
+    return likelihood - parameters / 2.0 * np.log(R), labels
+
+def _cluster_simpoints(simpoints, centroids, threshold):
+    '''
+    Merge simulation points of different threads whose phases have similar
+    centroids, so that a shared phase is only simulated once.
+
+    The simulation points are clustered leader-follower style, from the
+    largest to the smallest. A simulation point joins the closest leader if
+    their Manhattan distance, relative to the leader's 1-norm, is below the
+    threshold. Each cluster is represented by its leader, and its members
+    are listed under "members".
+    '''
+
+    # <leader, centroid>
+    leaders = []
+
+    order = sorted(
+        xrange(len(simpoints)), 
+        key=lambda i: simpoints[i]["global_weight"], 
+        reverse=True
+        )
+
+    for i in order:
+
+        #
+        simpoint, centroid = simpoints[i], centroids[i]
+
+        member = {"thread": simpoint["thread"],
+                  "pid": simpoint["pid"],
+                  "weight": simpoint["weight"],
+                  "thread_weight": simpoint["thread_weight"]
+                  }
+
+        # Find the closest leader
+        closest, distance = None, np.inf
+        for leader, leader_centroid in leaders:
+
+            if len(leader_centroid) != len(centroid):
+                continue
+
+            d = _cityblock(centroid, leader_centroid) / \
+                max(np.abs(leader_centroid).sum(), 1e-12)
+
+            if d < distance:
+                closest, distance = leader, d
+
+        #
+        if closest is not None and distance <= threshold:
+            closest["weight"] += simpoint["weight"]
+            closest["global_weight"] += simpoint["global_weight"]
+            closest["members"].append(member)
+        else:
+            leader = dict(simpoint)
+            leader["members"] = [ member ]
+            del leader["thread_weight"]
+
+            leaders.append((leader, centroid))
+
+    # Sort in thread and window order
+    return sorted(
+        [ cluster for cluster, _ in leaders ], 
+        key=lambda s: (s["thread"], s["offset"])
+        )
+
+def _cityblock(u, v):
+    return np.abs(u - v).sum()
 
 def run(args): 
     SimpointCmd(args).run();
@@ -0,0 +1,309 @@
+# Copyright (c) 2011-2013 Andreas Sembrant
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#  - Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  - Neither the name of the copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Authors: Andreas Sembrant
+
+'''
+Columnar cache of a thread's windows.
+
+The windows in a data file are converted once to numpy arrays, which are
+saved next to the data file and memory mapped by later invocations.
+
+<filename>.columns/
+    meta.json       - data file the columns were built from
+    phase.npy       - phase id,                    (N,)
+    size.npy        - window size,                 (N,)
+    time.npy        - window start and stop time,  (N, 2)
+    signature.npy   - signature frequency vector,  (N, D)
+    perf_ptr.npy    - perf sample offsets,         (N + 1,)
+    perf_cid.npy    - perf sample counter id,      (M,)
+    perf_value.npy  - perf sample value,           (M,)
+
+The perf samples are stored in CSR form, i.e., the samples of window i are
+perf_cid[perf_ptr[i]:perf_ptr[i + 1]] and perf_value[...].
+'''
+
+import os, json
+import numpy as np
+
+import pyscarphase.proto.data
+import pyscarphase.util.sidecar
+
+VERSION = 1
+
+COLUMNS = [
+    'phase', 
+    'size', 
+    'time', 
+    'signature', 
+    'perf_ptr', 
+    'perf_cid', 
+    'perf_value',
+    ]
+
+class Columns:
+    '''A thread's windows as numpy arrays.'''
+
+    def __init__(self, columns):
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.phase)
+
+    def perf_samples(self, index):
+        '''Get (cid, value) perf samples of a window.'''
+
+        start, stop = self.perf_ptr[index], self.perf_ptr[index + 1]
+
+        return zip(self.perf_cid[start:stop], self.perf_value[start:stop])
+
+
+def columns_dirname(filename):
+    return '%s.columns' % (filename)
+
+
+class _ColumnWriter:
+    '''
+    A column of unknown length, e.g., the perf samples, filled through a
+    fixed-size buffer.
+
+    Full buffers are written to <filename>_, or kept in memory if filename
+    is None. close() returns the column, which is copied to filename (a
+    memory mapped .npy file) a buffer at a time.
+    '''
+
+    def __init__(self, dtype, filename=None, buffer_size=64 * 1024):
+        self.dtype    = np.dtype(dtype)
+        self.filename = filename
+        self.buffer   = np.empty(buffer_size, dtype=self.dtype)
+        self.used     = 0
+        self.length   = 0
+
+        self.chunks = []
+        self.f      = None
+
+        if filename is not None:
+            self.f = open('%s_' % (filename), 'wb')
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, values):
+        n = len(values)
+
+        if self.used + n > len(self.buffer):
+            self.__flush()
+
+        if n > len(self.buffer):
+            self.__write(np.array(values, dtype=self.dtype))
+        else:
+            self.buffer[self.used:self.used + n] = values
+            self.used += n
+
+        self.length += n
+
+    def close(self):
+        self.__flush()
+
+        if self.f is None:
+            if not self.chunks:
+                return np.zeros(0, dtype=self.dtype)
+
+            return np.concatenate(self.chunks)
+
+        self.f.close()
+
+        tmpfile = '%s_' % (self.filename)
+
+        # Empty files can't be memory mapped, saved by the caller
+        if self.length == 0:
+            os.unlink(tmpfile)
+            return np.zeros(0, dtype=self.dtype)
+
+        column = np.lib.format.open_memmap(
+            self.filename, 
+            mode='w+', dtype=self.dtype, shape=(self.length,)
+            )
+
+        values = np.memmap(
+            tmpfile, mode='r', dtype=self.dtype, shape=(self.length,))
+
+        for a in xrange(0, self.length, len(self.buffer)):
+            b = min(a + len(self.buffer), self.length)
+            column[a:b] = values[a:b]
+
+        del values
+        os.unlink(tmpfile)
+
+        return column
+
+    def __flush(self):
+        if self.used > 0:
+            self.__write(self.buffer[:self.used])
+            self.used = 0
+
+    def __write(self, values):
+        if self.f is not None:
+            values.tofile(self.f)
+        else:
+            self.chunks.append(values.copy())
+
+
+def convert(reader, dirname=None):
+    '''
+    Convert all windows to columns in one pass.
+
+    The columns are written to dirname if given, otherwise they are kept
+    in memory.
+    '''
+
+    no_windows = len(reader)
+
+    # Signature dimension
+    no_dims = 0
+    if no_windows > 0:
+        no_dims = len(reader.get(0).phase_info.signature.fv_values)
+
+    def _allocate(name, dtype, shape):
+        # Empty files can't be memory mapped, those are saved at the end
+        if dirname is None or np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        else:
+            return np.lib.format.open_memmap(
+                os.path.join(dirname, '%s.npy' % (name)),
+                mode='w+', dtype=dtype, shape=shape
+                )
+
+    columns = {}
+    columns['phase']     = _allocate('phase', np.int32, (no_windows,))
+    columns['size']      = _allocate('size', np.float64, (no_windows,))
+    columns['time']      = _allocate('time', np.uint64, (no_windows, 2))
+    columns['signature'] = _allocate('signature', np.float64, 
+                                     (no_windows, no_dims))
+    columns['perf_ptr']  = _allocate('perf_ptr', np.int64, (no_windows + 1,))
+
+    # The number of perf samples is not known in advance
+    def _path(name):
+        if dirname is not None:
+            return os.path.join(dirname, '%s.npy' % (name))
+
+    perf_cid   = _ColumnWriter(np.int32, _path('perf_cid'))
+    perf_value = _ColumnWriter(np.uint64, _path('perf_value'))
+
+    reader.seek(0)
+    for i, w in enumerate(reader):
+
+        #
+        columns['phase'][i] = w.phase_info.phase
+        columns['size'][i]  = w.size
+        columns['time'][i]  = (w.time.start, w.time.stop)
+
+        #
+        fv_values = w.phase_info.signature.fv_values[:no_dims]
+        columns['signature'][i, :len(fv_values)] = fv_values
+
+        #
+        perf_cid.extend([ s.cid for s in w.perf_samples ])
+        perf_value.extend([ s.value for s in w.perf_samples ])
+
+        columns['perf_ptr'][i + 1] = len(perf_cid)
+
+    reader.seek(0)
+
+    columns['perf_cid']   = perf_cid.close()
+    columns['perf_value'] = perf_value.close()
+
+    if dirname is not None:
+        for name, values in columns.iteritems():
+            if isinstance(values, np.memmap):
+                values.flush()
+            else:
+                np.save(os.path.join(dirname, '%s.npy' % (name)), values)
+
+    return Columns(columns)
+
+
+def load(dirname, key, mmap_mode='r'):
+    '''Load columns, returns None if missing or built from another file.'''
+
+    try:
+        with open(os.path.join(dirname, 'meta.json'), 'r') as f:
+            if json.load(f) != key:
+                return None
+
+        columns = {}
+        for name in COLUMNS:
+            columns[name] = np.load(
+                os.path.join(dirname, '%s.npy' % (name)), 
+                mmap_mode=mmap_mode
+                )
+
+    except (IOError, OSError, ValueError):
+        return None
+
+    return Columns(columns)
+
+
+def load_columns(filename, uuid=None):
+    '''
+    Load the columns of a data file.
+
+    The data file is converted the first time, and the columns are saved
+    next to it. If they can't be saved, they are kept in memory.
+    '''
+
+    dirname = columns_dirname(filename)
+    key = pyscarphase.util.sidecar.file_key(filename, uuid)
+    key['version'] = VERSION
+
+    columns = load(dirname, key)
+
+    if columns is not None:
+        return columns
+
+    reader = pyscarphase.proto.data.DataReader(
+        filename, 
+        uuid=uuid, 
+        use_mmap=True
+        )
+
+    def _write(tmpdir):
+        os.mkdir(tmpdir)
+
+        convert(reader, tmpdir)
+
+        with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+            json.dump(key, f)
+
+    if not pyscarphase.util.sidecar.save(dirname, _write):
+
+        # Read-only directory etc, convert in memory instead
+        return convert(reader)
+
+    return load(dirname, key)
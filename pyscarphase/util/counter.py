@@ -28,6 +28,8 @@
 #
 # Authors: Andreas Sembrant
 
+import numpy as np
+
 def exec_func(cid, counters, dm_window):
     '''Execute counter function.
 
@@ -49,3 +51,90 @@ def exec_func(cid, counters, dm_window):
                 print c.name
 
     return eval(counters[cid].func, sampled_values)
+
+
+class CounterPlan:
+    '''
+    Evaluate counters over whole columns of demultiplexed values.
+
+    Each counter function, e.g., "cycles/instructions", is compiled once,
+    and evaluated with numpy arrays in place of the counter names. Only
+    the counters a function refers to (its dependencies) are passed in,
+    and functions can refer to other functions. Division by zero, or a
+    counter that was never sampled, gives nan.
+
+    plan = CounterPlan(profile.performance_counters)
+    values = plan.evaluate(dm.values)
+    '''
+
+    def __init__(self, counters, cids=None):
+        self.counters = counters
+
+        if cids is None:
+            cids = [ c.id for c in counters ]
+
+        self.cids = list(cids)
+
+        name_map = dict((c.name, c.id) for c in counters)
+
+        # cid -> (compiled function, dependencies)
+        self.funcs = {}
+
+        for c in counters:
+            if c.func == '':
+                continue
+
+            code = compile(c.func, c.name, 'eval')
+
+            self.funcs[c.id] = (
+                code, 
+                [ name_map[n] for n in code.co_names if n in name_map ]
+                )
+
+    def evaluate(self, values):
+        '''
+        Evaluate the counters, values is a (windows x counters) matrix,
+        e.g., Demultiplexer.values. Returns a (windows x cids) matrix.
+        '''
+
+        columns = {}
+
+        def _column(cid, visiting=()):
+
+            if cid in columns:
+                return columns[cid]
+
+            if cid not in self.funcs:
+                if cid < values.shape[1]:
+                    column = values[:, cid]
+                else:
+                    column = np.empty(values.shape[0])
+                    column.fill(np.nan)
+
+            else:
+                if cid in visiting:
+                    raise ValueError('Circular counter function: %s' % (
+                            self.counters[cid].name))
+
+                code, deps = self.funcs[cid]
+
+                scope = {}
+                for d in deps:
+                    scope[self.counters[d].name] = \
+                        _column(d, visiting + (cid,))
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    column = np.asarray(eval(code, scope), dtype=np.float64)
+
+                column = np.where(np.isfinite(column), column, np.nan)
+
+            columns[cid] = column
+
+            return column
+
+        result = np.empty((values.shape[0], len(self.cids)))
+
+        for i, cid in enumerate(self.cids):
+            result[:, i] = _column(cid)
+
+        return result
@@ -28,136 +28,634 @@
 #
 # Authors: Andreas Sembrant
 
+import os, json, itertools
 import numpy as np
 
+import pyscarphase.util.phase
+import pyscarphase.util.columns
+import pyscarphase.util.counter
+import pyscarphase.util.sidecar
+
+def _read_samples(reader):
+    '''
+    Read the phase, start and stop time and perf samples of all windows,
+    the samples in CSR form.
+    '''
+
+    phase_list, time, ptr, cids, values = [], [], [ 0 ], [], []
+
+    reader.seek(0)
+    for w in reader:
+        #
+        phase_list.append(w.phase_info.phase)
+        time.append((w.time.start, w.time.stop))
+
+        #
+        for s in w.perf_samples:
+            cids.append(s.cid)
+            values.append(s.value)
+
+        ptr.append(len(cids))
+
+    reader.seek(0)
+
+    return (np.array(phase_list, dtype=np.int64), 
+            np.array(time, dtype=np.float64).reshape((-1, 2)),
+            np.array(ptr, dtype=np.int64), 
+            np.array(cids, dtype=np.int64), 
+            np.array(values, dtype=np.float64))
+
+
+def _grouped_mean(groups, no_groups, cids, values, no_counters):
+    '''Mean of each (group, counter), nan if never sampled.'''
+
+    key = groups * no_counters + cids
+    size = no_groups * no_counters
+
+    sums   = np.bincount(key, weights=values, minlength=size)
+    counts = np.bincount(key, minlength=size)
+
+    with np.errstate(invalid='ignore'):
+        mean = sums / counts
+
+    return mean.reshape((no_groups, no_counters))
+
+
 class Demultiplexer:
+    '''
+    Reconstruct all counters of every window from the multiplexed samples.
 
+    A window only samples a few counters, the others are approximated by
+    the average of the same phase instance, phase or the whole program.
+    The result is a dense (windows x counters) matrix, with a matching
+    matrix of the level each value was taken from (-1 if the counter was
+    never sampled, the value is then nan).
 
-    class Type:
-        (WINDOW, INSTANCE, PHASE, PROGRAM) = range(0, 4)
+    The source is either a data reader, which is read once, or the
+    columns of a data file (see pyscarphase.util.columns).
 
-    def __init__(self, reader):
+    The strategy (see STRATEGIES) decides how the gaps are filled:
 
-        # Load all phases
-        import pyscarphase.util.phase
-        self.phase_list, self.phase_map = \
-            pyscarphase.util.phase.load_phase_hierarchy(reader)
+    average     - instance > phase > program average
+    phase       - phase > program average
+    nearest     - nearest sample in the same instance, else phase average
+    linear      - linear interpolation (in windows) between the samples
+                  in the same instance, else phase average
+    linear-time - same as linear, but in time
+    '''
 
-        class RunningAverage:
+    class Type:
+        (WINDOW, INSTANCE, PHASE, PROGRAM) = range(0, 4)
 
-            def __init__(self):
-                self.sum = 0
-                self.count = 0
+    def __init__(self, source, strategy='average'):
 
-            def add(self, x):
-                self.sum += x
-                self.count += 1
-                return self
+        if isinstance(source, pyscarphase.util.columns.Columns):
+            phase_list = np.asarray(source.phase)
+            time   = np.asarray(source.time, dtype=np.float64)
+            ptr    = np.asarray(source.perf_ptr)
+            cids   = np.asarray(source.perf_cid, dtype=np.int64)
+            values = np.asarray(source.perf_value, dtype=np.float64)
+        else:
+            phase_list, time, ptr, cids, values = _read_samples(source)
 
-        self.average = {}
+        # Middle of each window
+        self.time = time.mean(axis=1) if len(time) else np.zeros(0)
 
-        # Populate phases
-        for pid, phase in self.phase_map.iteritems():
-            #
-            phase.average = {}
+        # Find phase instances
+        self.hierarchy = pyscarphase.util.phase.PhaseHierarchy(phase_list)
+        self.phase_list = self.hierarchy.phase_list
 
-            # Add instance
-            for instance in phase.instances:
-                #
-                instance.average = {}
+        no_windows = len(self.phase_list)
+        no_counters = int(cids.max()) + 1 if len(cids) else 0
 
-                # Add samples
-                for i in xrange(len(instance.windows)):
-                    #
-                    value = {}
+        # Window, instance and phase of each sample
+        windows = np.repeat(np.arange(no_windows), np.diff(ptr))
+        instances = self.hierarchy.window_instance[windows]
+        phases = np.searchsorted(self.hierarchy.pids, self.phase_list)
 
-                    #
-                    for s in reader.get(instance.start + i).perf_samples:
-                        value[s.cid] = s.value
-                        
-                        instance.average[s.cid] = \
-                            instance.average.get(s.cid, RunningAverage()).add(s.value)
+        # Sampled values, nan if not sampled
+        self.window_values = np.empty((no_windows, no_counters))
+        self.window_values.fill(np.nan)
+        self.window_values[windows, cids] = values
 
-                        phase.average[s.cid] = \
-                            phase.average.get(s.cid, RunningAverage()).add(s.value)
+        # Averages
+        self.instance_average = _grouped_mean(
+            instances, len(self.hierarchy.instance_start), 
+            cids, values, no_counters)
 
-                        self.average[s.cid] = \
-                            self.average.get(s.cid, RunningAverage()).add(s.value)
+        self.phase_average = _grouped_mean(
+            phases[windows], len(self.hierarchy.pids), 
+            cids, values, no_counters)
 
-                    #
-                    instance.windows[i] = value
+        self.average = _grouped_mean(
+            np.zeros_like(cids), 1, cids, values, no_counters)[0]
 
-                for cid, average in instance.average.iteritems():
-                    instance.average[cid] = average.sum / average.count
+        self.__phases = phases
 
-            for cid, average in phase.average.iteritems():
-                phase.average[cid] = average.sum / average.count
+        #
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown strategy: %s' % (strategy))
 
-        for cid, average in self.average.iteritems():
-            self.average[cid] = average.sum / average.count
-            
+        self.strategy = strategy
+        self.values, self.levels = STRATEGIES[strategy](self)
 
-    def demultiplex(self, index, counter, level=Type.INSTANCE):
+    def __len__(self):
+        return len(self.phase_list)
+
+    def matrix(self, level=Type.INSTANCE):
         '''
-        Demultiplex counter.
+        Demultiplex all counters of all windows.
 
         Searches for best approximation or sample in:
 
         Window > Phase Instance > Phase > Program
 
+        starting at level. Returns (values, levels).
         '''
 
-        phase = self.phase_map[self.phase_list[index]]
+        T = Demultiplexer.Type
 
-        def _get_instance():
-            '''Get phase instance'''
+        shape = (len(self.phase_list), len(self.average))
 
-            for instance in phase.instances:
-                if index >= instance.start and \
-                   index <  instance.start + len(instance.windows):
-                    return instance
+        values = np.empty(shape)
+        values[:] = self.average
 
-            raise KeyError
+        levels = np.empty(shape, dtype=np.int8)
+        levels[:] = np.where(np.isnan(self.average), -1, T.PROGRAM)
 
-        instance = _get_instance()
+        # Fill in from the least to most accurate level
+        for t, v in [ 
+            (T.PHASE, lambda: self.phase_average[self.__phases]), 
+            (T.INSTANCE, lambda: 
+                 self.instance_average[self.hierarchy.window_instance]),
+            (T.WINDOW, lambda: self.window_values) 
+            ]:
 
-        # Check window
-        widx = index - instance.start
-        if level <= Demultiplexer.Type.WINDOW and \
-                counter in instance.windows[widx]:
-            return (instance.windows[widx][counter], Demultiplexer.Type.WINDOW)
-        
-        # Check instance
-        if level <= Demultiplexer.Type.INSTANCE and \
-                counter in instance.average:
-            return (instance.average[counter], Demultiplexer.Type.INSTANCE)
+            if level > t:
+                continue
 
-        # Check phase
-        if level <= Demultiplexer.Type.PHASE and \
-                counter in phase.average:
-            return (phase.average[counter], Demultiplexer.Type.PHASE)
+            v = v()
+            mask = ~np.isnan(v)
 
-        # Check program 
-        if counter in self.average:
-            return (self.average[counter], Demultiplexer.Type.PROGRAM)
+            values[mask] = v[mask]
+            levels[mask] = t
 
-        # Counter was never sampled, raise error
+        return values, levels
+
+    def interpolate(self, x=None, nearest=False):
+        '''
+        Fill the gaps from the samples of the same counter in the same
+        instance, by linear interpolation in x (default: window index),
+        or with the nearest sample. Instances without samples of a counter
+        fall back to the phase or program average.
+
+        Returns (values, levels), interpolated values have level INSTANCE.
+        '''
+
+        T = Demultiplexer.Type
+
+        values, levels = self.matrix(T.PHASE)
+
+        no_windows = len(self.phase_list)
+
+        if x is None:
+            x = np.arange(no_windows, dtype=np.float64)
+
+        windows  = np.arange(no_windows)
+        instance = self.hierarchy.window_instance
+
+        for c in xrange(len(self.average)):
+            sampled = np.flatnonzero(~np.isnan(self.window_values[:, c]))
+
+            if len(sampled) == 0:
+                continue
+
+            v = self.window_values[sampled, c]
+
+            # Previous (or same) and next sample of each window
+            i = np.searchsorted(sampled, windows, 'right') - 1
+
+            prev_i = np.maximum(i, 0)
+            next_i = np.minimum(i + 1, len(sampled) - 1)
+
+            before, after = sampled[prev_i], sampled[next_i]
+
+            # Only use samples in the same instance
+            has_prev = (i >= 0) & (instance[before] == instance)
+            has_next = (i + 1 < len(sampled)) & (instance[after] == instance)
+
+            if nearest:
+                use_next = has_next & \
+                    (~has_prev | (x[after] - x < x - x[before]))
+
+                result = np.where(use_next, v[next_i], v[prev_i])
+            else:
+                result = np.where(has_prev, v[prev_i], v[next_i])
+
+                both = has_prev & has_next & (x[after] != x[before])
 
-        raise KeyError              
+                w = (x[both] - x[before[both]]) / \
+                    (x[after[both]] - x[before[both]])
 
+                result[both] = v[prev_i[both]] + \
+                    w * (v[next_i[both]] - v[prev_i[both]])
+
+            mask = has_prev | has_next
+
+            values[mask, c] = result[mask]
+            levels[mask, c] = T.INSTANCE
+            levels[sampled, c] = T.WINDOW
+
+        return values, levels
+
+    def demultiplex(self, index, counter, level=None):
+        '''
+        Demultiplex counter, returns (value, level).
+
+        If level is None, the value is taken from the matrix of the
+        strategy, otherwise the first average at or above level is used.
+
+        Raises KeyError if the counter was never sampled.
+        '''
+
+        if counter >= len(self.average):
+            raise KeyError(counter)
+
+        if level is None:
+            value, t = self.values[index, counter], self.levels[index, counter]
+        else:
+            T = Demultiplexer.Type
+
+            for t, v in [
+                (T.WINDOW, self.window_values[index]),
+                (T.INSTANCE, self.instance_average[
+                        self.hierarchy.instance(index)]),
+                (T.PHASE, self.phase_average[self.__phases[index]]),
+                (T.PROGRAM, self.average),
+                ]:
+
+                if level <= t and not np.isnan(v[counter]):
+                    break
+
+            value = v[counter]
+
+        # Counter was never sampled, raise error
+        if np.isnan(value):
+            raise KeyError(counter)
+
+        return (value, t)
 
     def read(self):
         
         class Window:
 
-            def __init__(self, demultiplexer, index, phase):
-                self.demultiplexer = demultiplexer
+            def __init__(self, index, phase, values, levels):
                 self.index = index
                 self.phase = phase
+                self.values = values
+                self.levels = levels
 
             def value(self, counter):
-                return self.demultiplexer.demultiplex(self.index, counter)
+                if counter >= len(self.values) or \
+                        self.values[counter] != self.values[counter]:
+                    raise KeyError(counter)
+
+                return (self.values[counter], self.levels[counter])
         
-        for i, pid in enumerate(self.phase_list):
-            yield Window(self, i, pid)
+        for i, pid in enumerate(self.phase_list.tolist()):
+            yield Window(i, pid, 
+                         self.values[i].tolist(), self.levels[i].tolist())
+
+
+# name -> function(demultiplexer) -> (values, levels)
+STRATEGIES = {
+    'average'     : lambda dm: dm.matrix(Demultiplexer.Type.INSTANCE),
+    'phase'       : lambda dm: dm.matrix(Demultiplexer.Type.PHASE),
+    'nearest'     : lambda dm: dm.interpolate(nearest=True),
+    'linear'      : lambda dm: dm.interpolate(),
+    'linear-time' : lambda dm: dm.interpolate(x=dm.time),
+    }
+
+
+def _read_chunks(source, chunk_size):
+    '''
+    Read the phase and perf samples of chunk_size windows at a time,
+    yields (phase_list, sample window, sample cid, sample value), where
+    the sample window is relative to the chunk.
+    '''
+
+    if isinstance(source, pyscarphase.util.columns.Columns):
+        for start in xrange(0, len(source), chunk_size):
+            stop = min(start + chunk_size, len(source))
+
+            ptr = np.asarray(source.perf_ptr[start:stop + 1])
+
+            yield (np.asarray(source.phase[start:stop], dtype=np.int64),
+                   np.repeat(np.arange(stop - start), np.diff(ptr)),
+                   np.asarray(source.perf_cid[ptr[0]:ptr[-1]], 
+                              dtype=np.int64),
+                   np.asarray(source.perf_value[ptr[0]:ptr[-1]], 
+                              dtype=np.float64))
+
+        return
+
+    source.seek(0)
+
+    while True:
+        windows = list(itertools.islice(source, chunk_size))
+
+        if not windows:
+            break
+
+        phase_list, sample_windows, cids, values = [], [], [], []
+
+        for i, w in enumerate(windows):
+            phase_list.append(w.phase_info.phase)
+
+            for s in w.perf_samples:
+                sample_windows.append(i)
+                cids.append(s.cid)
+                values.append(s.value)
+
+        yield (np.array(phase_list, dtype=np.int64),
+               np.array(sample_windows, dtype=np.int64),
+               np.array(cids, dtype=np.int64),
+               np.array(values, dtype=np.float64))
+
+    source.seek(0)
+
+
+class ChunkedDemultiplexer:
+    '''
+    Demultiplex traces that do not fit in memory.
+
+    The source (a reader or columns) is read twice, chunk_size windows at
+    a time. The first pass sums the samples of each instance and phase,
+    the second fills in the windows of each chunk from the averages. The
+    memory use depends on the number of instances and counters, not on
+    the number of windows.
+
+    Only the average and phase strategies are supported, the other
+    strategies need the neighbouring samples of each window.
+    '''
+
+    STRATEGIES = {
+        'average' : Demultiplexer.Type.INSTANCE, 
+        'phase'   : Demultiplexer.Type.PHASE 
+        }
+
+    def __init__(self, source, no_counters, strategy='average', 
+                 chunk_size=64 * 1024):
+
+        if strategy not in self.STRATEGIES:
+            raise ValueError('Unsupported strategy: %s' % (strategy))
+
+        self.source      = source
+        self.no_counters = no_counters
+        self.strategy    = strategy
+        self.level       = self.STRATEGIES[strategy]
+        self.chunk_size  = chunk_size
+
+        self.__sum()
+
+    def __instances(self, phase_list, last):
+        '''Instance of each window, last is (instance, pid) before.'''
+
+        changes = np.empty(len(phase_list), dtype=np.int64)
+        changes[0]  = last[1] is None or phase_list[0] != last[1]
+        changes[1:] = phase_list[1:] != phase_list[:-1]
+
+        return last[0] + np.cumsum(changes)
+
+    def __sum(self):
+        '''First pass, average of each instance, phase and the program.'''
+
+        C = self.no_counters
+
+        def _grow(a, size):
+            if size <= len(a):
+                return a
+
+            b = np.zeros((max(size, 2 * len(a)), C))
+            b[:len(a)] = a
+
+            return b
+
+        instance_sums   = np.zeros((1024, C))
+        instance_counts = np.zeros((1024, C))
+
+        # pid -> row
+        phase_rows = {}
+
+        phase_sums   = np.zeros((0, C))
+        phase_counts = np.zeros((0, C))
+
+        sums   = np.zeros(C)
+        counts = np.zeros(C)
+
+        no_windows, last = 0, (-1, None)
+
+        for phase_list, windows, cids, values in \
+                _read_chunks(self.source, self.chunk_size):
+
+            # Ignore unknown counters
+            known = cids < C
+            windows, cids, values = windows[known], cids[known], values[known]
+
+            # Instances
+            instances = self.__instances(phase_list, last)
+
+            first = instances[0]
+            no_instances = instances[-1] - first + 1
+
+            instance_sums   = _grow(instance_sums, first + no_instances)
+            instance_counts = _grow(instance_counts, first + no_instances)
+
+            key = (instances[windows] - first) * C + cids
+
+            instance_sums[first:first + no_instances] += np.bincount(
+                key, weights=values, minlength=no_instances * C
+                ).reshape((no_instances, C))
+            instance_counts[first:first + no_instances] += np.bincount(
+                key, minlength=no_instances * C
+                ).reshape((no_instances, C))
+
+            # Phases
+            pids, inverse = np.unique(phase_list, return_inverse=True)
+
+            for pid in pids.tolist():
+                if pid not in phase_rows:
+                    phase_rows[pid] = len(phase_rows)
+
+            rows = np.array([ phase_rows[pid] for pid in pids.tolist() ])
+
+            phase_sums   = _grow(phase_sums, len(phase_rows))
+            phase_counts = _grow(phase_counts, len(phase_rows))
+
+            key = inverse[windows] * C + cids
+
+            phase_sums[rows] += np.bincount(
+                key, weights=values, minlength=len(pids) * C
+                ).reshape((len(pids), C))
+            phase_counts[rows] += np.bincount(
+                key, minlength=len(pids) * C
+                ).reshape((len(pids), C))
+
+            # Program
+            sums   += np.bincount(cids, weights=values, minlength=C)
+            counts += np.bincount(cids, minlength=C)
+
+            no_windows += len(phase_list)
+            last = (instances[-1], phase_list[-1])
+
+        no_instances = last[0] + 1
+
+        with np.errstate(invalid='ignore'):
+            self.instance_average = instance_sums[:no_instances] / \
+                instance_counts[:no_instances]
+            self.phase_average = phase_sums[:len(phase_rows)] / \
+                phase_counts[:len(phase_rows)]
+            self.average = sums / counts
+
+        self.phase_rows = phase_rows
+        self.no_windows = no_windows
+
+    def __len__(self):
+        return self.no_windows
+
+    def read(self):
+        '''
+        Second pass, yields (phase_list, values, levels) of each chunk, 
+        see Demultiplexer.matrix().
+        '''
+
+        T = Demultiplexer.Type
+        C = self.no_counters
+
+        last = (-1, None)
+
+        for phase_list, windows, cids, sample_values in \
+                _read_chunks(self.source, self.chunk_size):
+
+            instances = self.__instances(phase_list, last)
+            last = (instances[-1], phase_list[-1])
+
+            shape = (len(phase_list), C)
+
+            values = np.empty(shape)
+            values[:] = self.average
+
+            levels = np.empty(shape, dtype=np.int8)
+            levels[:] = np.where(np.isnan(self.average), -1, T.PROGRAM)
+
+            rows = np.array([ self.phase_rows[pid] 
+                              for pid in phase_list.tolist() ])
+
+            for t, v in [
+                (T.PHASE, lambda: self.phase_average[rows]),
+                (T.INSTANCE, lambda: self.instance_average[instances]),
+                ]:
+
+                if self.level > t:
+                    continue
+
+                v = v()
+                mask = ~np.isnan(v)
+
+                values[mask] = v[mask]
+                levels[mask] = t
+
+            yield phase_list, values, levels
+
+    def matrix(self, values=None, levels=None):
+        '''
+        Demultiplex all windows into values and levels, e.g., memory 
+        mapped arrays (see numpy.lib.format.open_memmap). Returns 
+        (values, levels).
+        '''
+
+        shape = (self.no_windows, self.no_counters)
+
+        if values is None:
+            values = np.empty(shape)
+
+        if levels is None:
+            levels = np.empty(shape, dtype=np.int8)
+
+        start = 0
+        for phase_list, v, l in self.read():
+            values[start:start + len(phase_list)] = v
+            levels[start:start + len(phase_list)] = l
+
+            start += len(phase_list)
+
+        return values, levels
+
+
+#
+CACHE_VERSION = 1
+
+def cache_filename(filename, strategy='average'):
+    return '%s.demux-%s.npz' % (filename, strategy)
+
+
+def _cache_key(filename, uuid, counters, strategy):
+    '''Identify the data file and counter definitions of a cache.'''
+
+    key = pyscarphase.util.sidecar.file_key(filename, uuid)
+
+    key.update({
+        'version'  : CACHE_VERSION,
+        'strategy' : strategy,
+        'counters' : [ 
+            [ c.id, c.name, c.func, 
+              c.config if c.HasField('config') else None ] 
+            for c in counters ],
+        })
+
+    return key
+
+
+def load_counters(filename, uuid, counters, strategy='average'):
+    '''
+    Demultiplex and evaluate all counters of a data file.
+
+    Returns (phase_list, values), where values is a (windows x counters)
+    matrix. The result is cached next to the data file, and is rebuilt
+    if the data file or the counter definitions change.
+    '''
+
+    cachefile = cache_filename(filename, strategy)
+    key = json.dumps(_cache_key(filename, uuid, counters, strategy))
+
+    try:
+        with np.load(cachefile) as cache:
+            if str(cache['key']) == key:
+                return cache['phase_list'], cache['values']
+
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    columns = pyscarphase.util.columns.load_columns(filename, uuid)
+
+    dm = Demultiplexer(columns, strategy)
+
+    plan = pyscarphase.util.counter.CounterPlan(counters)
+    values = plan.evaluate(dm.values)
+
+    def _write(tmpfile):
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, key=np.array(key), 
+                     phase_list=dm.phase_list, values=values)
+
+    pyscarphase.util.sidecar.save(cachefile, _write)
+
+    return dm.phase_list, values
+
+
+def clear_cache(filename):
+    '''Remove the cached counters of a data file, e.g., after refine.'''
 
+    for strategy in STRATEGIES:
+        if os.path.exists(cache_filename(filename, strategy)):
+            os.unlink(cache_filename(filename, strategy))
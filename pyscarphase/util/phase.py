@@ -28,21 +28,11 @@
 #
 # Authors: Andreas Sembrant
 
-class Instance:
+import numpy as np
 
-    def __init__(self, start):
-        self.start = start
-        self.windows = []
+import pyscarphase.util.runlength
 
-
-class Phase:
-
-    def __init__(self, pid):
-        self.pid = pid
-        self.instances = []      
-        
-
-def load_phase_hierarchy(reader):
+class PhaseHierarchy:
     '''
     phase -> instance -> window
                       -> window
@@ -53,45 +43,85 @@ def load_phase_hierarchy(reader):
 
     ...
 
+    A phase instance is a run of consecutive windows with the same phase.
+    The hierarchy is stored as numpy arrays:
+
+    phase_list       - phase id of each window,           (N,)
+    instance_start   - first window of each instance,     (I,)
+    instance_length  - no. windows in each instance,      (I,)
+    instance_phase   - phase id of each instance,         (I,)
+    window_instance  - instance of each window,           (N,)
+    pids             - phase ids, sorted,                 (P,)
+
+    The instances of a phase are in window order.
     '''
-    
-    #
-    phase_list = []
 
-    #
-    phase_map = {}
+    def __init__(self, phase_list):
+        self.phase_list = np.asarray(phase_list, dtype=np.int64)
 
-    # Last phase
-    _pid = -1
+        # Find phase changes
+        self.instance_phase, self.instance_length, self.instance_start = \
+            pyscarphase.util.runlength.encode(self.phase_list)
 
-    #
-    reader.seek(0)
+        self.window_instance = np.repeat(
+            np.arange(len(self.instance_start)), self.instance_length)
 
-    #
-    for i, w in enumerate(reader):
+        # Group the instances by phase
+        self.__order = np.argsort(self.instance_phase, kind='mergesort')
+
+        self.pids, self.__bounds = np.unique(
+            self.instance_phase[self.__order], return_index=True)
+        self.__bounds = np.append(self.__bounds, len(self.__order))
+
+    def __len__(self):
+        return len(self.phase_list)
+
+    def __contains__(self, pid):
+        return self.__phase_index(pid) is not None
+
+    def __phase_index(self, pid):
+        i = np.searchsorted(self.pids, pid)
 
-        # Current phase
-        pid = w.phase_info.phase
+        if i == len(self.pids) or self.pids[i] != pid:
+            return None
 
-        # If first time we see this phase
-        if not pid in phase_map:
-            phase_map[pid] = Phase(pid)
-            phase_map[pid].instances.append(Instance(i))
-            phase_map[pid].instances[-1].windows.append(None)
+        return i
 
-        else:
+    def instance(self, index):
+        '''Instance of a window.'''
 
-            # If phase change
-            if _pid != pid: 
-                phase_map[pid].instances.append(Instance(i))
+        return self.window_instance[index]
 
-            phase_map[pid].instances[-1].windows.append(None)
+    def instances(self, pid):
+        '''Instances of a phase.'''
 
-        #
-        phase_list.append(pid)
+        i = self.__phase_index(pid)
 
-        #
-        _pid = pid
+        if i is None:
+            raise KeyError(pid)
+
+        return self.__order[self.__bounds[i]:self.__bounds[i + 1]]
+
+    def windows(self, instance):
+        '''Windows [start, stop) of an instance.'''
+
+        start = self.instance_start[instance]
+
+        return start, start + self.instance_length[instance]
+
+
+def load_phase_hierarchy(reader):
+    '''Read the phase of all windows, and build the phase hierarchy.'''
+    
+    #
+    reader.seek(0)
+
+    #
+    phase_list = np.fromiter(
+        (w.phase_info.phase for w in reader), dtype=np.int64)
+
+    #
+    reader.seek(0)
 
     #
-    return (phase_list, phase_map)
+    return PhaseHierarchy(phase_list)
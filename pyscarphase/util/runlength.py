@@ -28,7 +28,12 @@
 #
 # Authors: Andreas Sembrant
 
-class RunLength:
+import numpy as np
+
+class RunLength(object):
+
+    # No per object dict, requires a new-style class
+    __slots__ = [ 'pid', 'length' ]
 
     def __init__(self, pid, length = 1):
         assert(length >= 0)
@@ -51,24 +56,51 @@ class RunLength:
 
 def encode(phase_list):
     '''
-    Runlength encode a list of phases.
+    Runlength encode a list of phases, returns (pids, lengths, starts).
 
     e.g.
-    [ 1, 1, 1, 2, 2, 1] -> [ (1, 3), (2, 2), (1, 1) ]
+    [ 1, 1, 1, 2, 2, 1] -> ([ 1, 2, 1 ], [ 3, 2, 1 ], [ 0, 3, 5 ])
 
     '''
 
-    encoded_list = []
-    
-    _pid = -1
-    for pid in phase_list:
-        if pid == _pid:
-            encoded_list[-1] += 1
-        else:
-            encoded_list.append(RunLength(pid, 1))
-            
-        _pid = pid
+    phase_list = np.asarray(phase_list)
+
+    if len(phase_list) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # Start of each run
+    starts = np.concatenate(
+        ([ 0 ], np.flatnonzero(phase_list[1:] != phase_list[:-1]) + 1)
+        )
 
-    return encoded_list
+    lengths = np.diff(np.append(starts, len(phase_list)))
+
+    return phase_list[starts], lengths, starts
+
+
+def decode(pids, lengths):
+    '''
+    Runlength decode, the inverse of encode.
+
+    e.g.
+    ([ 1, 2, 1 ], [ 3, 2, 1 ]) -> [ 1, 1, 1, 2, 2, 1]
+
+    '''
+
+    return np.repeat(pids, lengths)
+
+
+def encode_list(phase_list):
+    '''
+    Runlength encode a list of phases.
+
+    e.g.
+    [ 1, 1, 1, 2, 2, 1] -> [ (1, 3), (2, 2), (1, 1) ]
+
+    '''
 
+    pids, lengths, _ = encode(phase_list)
 
+    return [ RunLength(pid, length) 
+             for pid, length in zip(pids.tolist(), lengths.tolist()) ]
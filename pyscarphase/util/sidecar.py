@@ -0,0 +1,91 @@
+# Copyright (c) 2011-2013 Andreas Sembrant
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#  - Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  - Neither the name of the copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Authors: Andreas Sembrant
+
+'''
+Caches kept next to a data file, i.e., the offset index (<filename>.idx),
+the columns (<filename>.columns/) and the demultiplexed counters
+(<filename>.demux-<strategy>.npz).
+
+Each cache records the key of the data file it was built from, and is
+rebuilt when the key changes. Caches are built under a temporary name,
+and moved into place when done.
+'''
+
+import os, shutil, binascii
+
+def file_key(filename, uuid):
+    '''Identify the data file a cache is built from.'''
+
+    st = os.stat(filename)
+
+    return {
+        'uuid'    : binascii.hexlify(uuid or ''),
+        'size'    : st.st_size,
+        'mtime'   : st.st_mtime,
+        }
+
+
+def save(path, write):
+    '''
+    Build a cache file or directory with write(<temporary path>), and move
+    it into place. Returns False if the cache can't be written.
+    '''
+
+    tmppath = '%s_' % (path)
+
+    try:
+        _remove(tmppath)
+
+        write(tmppath)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+        os.rename(tmppath, path)
+
+    except (IOError, OSError):
+
+        # Read-only directory etc, the caches are just an optimization
+        try:
+            _remove(tmppath)
+        except (IOError, OSError):
+            pass
+
+        return False
+
+    return True
+
+
+def _remove(path):
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.unlink(path)